@@ -1,11 +1,9 @@
-import asyncio
 import sqlalchemy
 import asyncpgsa
 from sqlalchemy import Table, Column
 
 from restycorn.base_resource import BaseResource
 from restycorn.postgresql_read_only_resource import PostgreSQLReadOnlyResource
-from restycorn.restycorn_types import uint
 from restycorn.server import Server
 from restycorn.exceptions import ResourceItemDoesNotExistException
 from restycorn.postgresql_serializer import PostgreSQLSerializer
@@ -83,7 +81,7 @@ class TestResource(BaseResource):
         del self.db[item_id]
 
 
-async def main():
+async def connect_to_database():
     await asyncpgsa.pg.init(
         user='pikabot_graphs',
         password='pikabot_graphs',
@@ -92,8 +90,18 @@ async def main():
         max_size=10,
     )
 
+
+async def close_database():
+    await asyncpgsa.pg.pool.close()
+
+
+def main():
     server = Server()
     server.set_base_address('/api')
+    # every worker process connects to database after it's started
+    server.add_startup_handler(connect_to_database)
+    server.add_cleanup_handler(close_database)
+    server.enable_metrics()
 
     metadata = sqlalchemy.MetaData()
 
@@ -190,9 +198,13 @@ async def main():
         id_field='id',
         order_by=('id', ),
         filter_by={
-            'user_id': ('=', ),
+            'user_id': ('=', 'in', ),
+            'timestamp': ('>=', '<=', 'between', ),
         },
         paginated=False,
+        streamed=True,
+        time_field='timestamp',
+        value_fields=('value', ),
     ))
 
     communities_app_communitycountersentry = Table(
@@ -211,9 +223,13 @@ async def main():
             id_field='community_id',
             order_by=('id',),
             filter_by={
-                'community_id': ('=',),
+                'community_id': ('=', 'in', ),
+                'timestamp': ('>=', '<=', 'between', ),
             },
             paginated=False,
+            streamed=True,
+            time_field='timestamp',
+            value_fields=(resource_name, ),
         ))
 
     register_community_graph_item_resource('subscribers_count')
@@ -247,10 +263,20 @@ async def main():
     #         pikabu_new_year_18_game_app_scoreentry.c.scoreboard_entry_id
     #     ),
     # ))
-    server.register_resource(
-        'new_year_2018_game/scoreboards',
-        Scoreboards(pikabu_new_year_18_game_app_scoreboardentry, pikabu_new_year_18_game_app_scoreentry)
-    )
+    server.register_resource('new_year_2018_game/scoreboards', PostgreSQLReadOnlyResource(
+        sqlalchemy_table=pikabu_new_year_18_game_app_scoreboardentry,
+        fields=('id', 'parse_timestamp', ),
+        id_field='id',
+        order_by=('parse_timestamp', 'id', ),
+        page_size=50,
+        embed={
+            'score_entries': {
+                'table': pikabu_new_year_18_game_app_scoreentry,
+                'foreign_key': 'scoreboard_entry_id',
+                'fields': ('username', 'avatar_url', 'score', 'date', ),
+            },
+        },
+    ))
 
     pikabu_new_year_18_game_app_topitem = Table(
         'pikabu_new_year_18_game_app_topitem', metadata,
@@ -273,43 +299,5 @@ async def main():
     return server
 
 
-class Scoreboards(BaseResource):
-    def __init__(self, scoreboardentry_table, scoreentry_table):
-        self.scoreboardentry_table = scoreboardentry_table
-        self.scoreentry_table = scoreentry_table
-
-    async def list(self, page: uint=0) -> list:
-        sql_request = self.scoreboardentry_table.select().order_by(
-            self.scoreboardentry_table.c.parse_timestamp).limit(50)
-
-        if page:
-            sql_request = sql_request.offset(page * 50)
-
-        items = await asyncpgsa.pg.fetch(sql_request)
-
-        result = [PostgreSQLSerializer(('id', 'parse_timestamp')).serialize(item) for item in items]
-
-        for i in range(len(result)):
-            sql_request = sqlalchemy.select(['*']).select_from(self.scoreentry_table).where(
-                self.scoreentry_table.c.scoreboard_entry_id == result[i]['id']
-            )
-
-            print(str(sql_request))
-            print(str(sql_request.compile().params))
-
-            score_entries = [
-                PostgreSQLSerializer(
-                    ('username', 'avatar_url', 'score', 'date', )
-                ).serialize(item)
-                for item in (await asyncpgsa.pg.fetch(sql_request))
-            ]
-
-            result[i]['score_entries'] = score_entries
-
-        return result
-
-
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-
-    loop.run_until_complete(main()).run()
+    main().run(workers=4)
@@ -5,6 +5,50 @@ class BaseResource:
     time_cached = False
     time_cache_seconds = 10
     time_cache_size = 16
+    time_cache_max_bytes = 16 * 1024 * 1024
+    # expired entry is still served during this time while it's being refreshed in background,
+    # after that requests wait for fresh response
+    time_cache_stale_seconds = 0
+    # entry requested less than this time before its expiration is refreshed in background beforehand
+    time_cache_refresh_ahead_seconds = 0
+    # maximum number of requests to resource processed at the same time, None means unlimited
+    concurrency_limit = None
+    # limits of separate methods, like {'list': 2}, so expensive methods don't occupy all connections
+    method_concurrency_limits = {}
+    # requests over limit wait in queue of this size not longer than concurrency_queue_seconds,
+    # otherwise they are rejected with 503
+    concurrency_queue_size = 100
+    concurrency_queue_seconds = 1.0
+    # ResourceMetrics set by request handler, resource can record time of its stages to it
+    metrics = None
+
+    def is_streamed(self, method_name: str, params: dict) -> bool:
+        """
+        Returns True if method called with these params returns RowStream,
+        such responses are written to client in chunks instead of being cached
+
+        :param method_name: name of resource method
+        :param params: validated params of request
+        :return:
+        """
+        return False
+
+    def canonical_params(self, method_name: str, params: dict) -> dict:
+        """
+        Returns params with values which give the same result replaced by one of them,
+        so such requests share cache entry and are coalesced
+
+        :param method_name: name of resource method
+        :param params: validated params of request with applied defaults
+        :return:
+        """
+        return params
+
+    def caches(self) -> dict:
+        """
+        Returns caches of resource with stats method by their names, their stats are exposed in metrics
+        """
+        return {}
 
     @abc.abstractmethod
     async def list(self) -> list:
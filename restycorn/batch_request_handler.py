@@ -0,0 +1,167 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+from yarl import URL
+
+from .json_encoders import get_json_encoder
+
+
+class BatchSubRequest:
+    """
+    Request which is part of batch request, has attributes of aiohttp request used by ResourceRequestHandler
+    and pre request function of server. Headers and remote are ones of batch request
+    """
+
+    def __init__(self, method: str, path: str, query: dict, batch_request=None):
+        """
+        :param path: absolute path of sub request like "/api/users/admin"
+        :param batch_request: aiohttp request of the whole batch
+        """
+        self.method = method
+        self.url = URL(path).with_query({key: str(val) for key, val in query.items()})
+        self.rel_url = self.url
+        self.path = self.url.path
+        self.query = self.url.query
+        self.batch_request = batch_request
+        self.headers = batch_request.headers if batch_request is not None else {}
+        self.remote = batch_request.remote if batch_request is not None else None
+
+
+class BatchRequestHandler:
+    """
+    Handles POST request with list of sub requests like {"method": "GET", "path": "users/admin", "query": {}},
+    makes them concurrently through handlers of resources and returns all responses at once
+    """
+
+    def __init__(self, resource_handlers: dict, base_address: str, max_concurrency: int=8, max_requests: int=50,
+                 json_encoder='json', pre_request=None):
+        """
+        :param resource_handlers: resource name -> ResourceRequestHandler
+        :param base_address: base address of resources which is removed from paths of sub requests
+        :param max_concurrency: maximum number of sub requests which are made at the same time
+        :param max_requests: maximum number of sub requests in one batch
+        :param pre_request: coroutine function called with every BatchSubRequest, if it returns response,
+            it's used instead of response of resource, like pre request function of server for usual requests
+        """
+        self.resource_handlers = resource_handlers
+        self.pre_request = pre_request
+        self.base_address = base_address.strip('/')
+        self.max_concurrency = max_concurrency
+        self.max_requests = max_requests
+        self.json_encoder = get_json_encoder(json_encoder)
+
+    async def request_batch(self, request: aiohttp.ClientRequest):
+        if request.method != 'POST':
+            return self._json_response({
+                'status': 'error',
+                'error_message': 'Method "{}" is not allowed here'.format(request.method)
+            }, 405)
+
+        try:
+            sub_requests = await request.json()
+        except ValueError:
+            return self._json_response({
+                'status': 'error',
+                'error_message': 'Body should be json list of requests',
+            }, 400)
+
+        if type(sub_requests) is not list or any(type(sub_request) is not dict for sub_request in sub_requests):
+            return self._json_response({
+                'status': 'error',
+                'error_message': 'Body should be json list of requests',
+            }, 400)
+
+        if len(sub_requests) > self.max_requests:
+            return self._json_response({
+                'status': 'error',
+                'error_message': 'Too many requests in batch, maximum is {}'.format(self.max_requests),
+            }, 400)
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def make_sub_request(sub_request):
+            async with semaphore:
+                return await self._make_sub_request(request, sub_request)
+
+        responses = await asyncio.gather(*[make_sub_request(sub_request) for sub_request in sub_requests])
+
+        # bodies are already encoded, so they are put into response as is
+        body = b'{"status": "ok", "data": [' + b', '.join(
+            b'{"status": ' + str(status).encode() + b', "body": ' + body + b'}' for body, status in responses
+        ) + b']}'
+
+        return web.Response(body=body, content_type='application/json', charset='utf-8')
+
+    async def _make_sub_request(self, request, sub_request: dict) -> tuple:
+        method = str(sub_request.get('method', 'GET')).upper()
+        path = str(sub_request.get('path', ''))
+        query = sub_request.get('query') or {}
+
+        if method != 'GET':
+            return self._encode_error('Method "{}" is not allowed in batch'.format(method), 405)
+
+        if type(query) is not dict:
+            return self._encode_error('query should be object', 400)
+
+        relative_path = self._relative_path(path)
+        # the same path as if sub request was made directly, so pre request checks of paths apply to it
+        sub_request = BatchSubRequest(
+            method, '/' + '/'.join(part for part in (self.base_address, relative_path) if part), query, request)
+
+        if self.pre_request is not None:
+            pre_result = await self.pre_request(sub_request)
+            if pre_result is not None:
+                return self._encode_pre_request_response(pre_result)
+
+        handler, item_id = self._resolve(relative_path)
+        if handler is None:
+            return self._encode_error('Resource "{}" does not exist'.format(path), 404)
+
+        return await handler.batch_request(sub_request, item_id)
+
+    def _relative_path(self, path: str) -> str:
+        """
+        Returns path like "users/admin" relative to base address from path like "/api/users/admin" or "users/admin"
+        """
+        path = path.strip('/')
+        if self.base_address and path.startswith(self.base_address + '/'):
+            path = path[len(self.base_address) + 1:]
+
+        return path
+
+    def _resolve(self, path: str) -> tuple:
+        """
+        Finds handler of resource by path relative to base address like "users/admin"
+
+        :return: tuple (handler, item_id), handler is None if there is no such resource
+        """
+        if path in self.resource_handlers:
+            return self.resource_handlers[path], None
+
+        if '/' in path:
+            resource_name, item_id = path.rsplit('/', 1)
+            if resource_name in self.resource_handlers and item_id:
+                return self.resource_handlers[resource_name], item_id
+
+        return None, None
+
+    def _encode_pre_request_response(self, response: web.Response) -> tuple:
+        """
+        Returns body and status of response of pre request function, body which isn't json
+        is put to error message, so the whole batch response stays valid json
+        """
+        if response.content_type == 'application/json' and response.body:
+            return bytes(response.body), response.status
+
+        return self._encode_error(response.text or response.reason, response.status)
+
+    def _encode_error(self, error_message: str, status: int) -> tuple:
+        return self.json_encoder({
+            'status': 'error',
+            'error_message': error_message,
+        }), status
+
+    def _json_response(self, data, status: int=200) -> web.Response:
+        return web.Response(body=self.json_encoder(data), status=status, content_type='application/json',
+                            charset='utf-8')
@@ -0,0 +1,106 @@
+import asyncio
+import collections
+import contextlib
+import math
+import time
+
+from .exceptions import ResourceOverloadedException
+
+
+class ConcurrencyLimiter:
+    """
+    Limits number of requests processed at the same time, the rest wait in queue of limited size and time.
+    Request is rejected at once if queue is full or it would wait longer than queue_seconds
+    according to average processing time
+    """
+
+    # weight of the last processing time in average one
+    _average_weight = 0.1
+
+    def __init__(self, limit: int, queue_size: int, queue_seconds: float):
+        """
+        :param limit: maximum number of requests processed at the same time
+        :param queue_size: maximum number of waiting requests
+        :param queue_seconds: maximum time of waiting
+        """
+        if limit < 1:
+            raise ValueError("limit should be positive")
+
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_seconds = queue_seconds
+        self.active = 0
+        self.rejected = 0
+        self.average_seconds = 0.0
+        self._waiters = collections.deque()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, deadline: float=None):
+        """
+        :param deadline: time.monotonic() after which request stops waiting, if it's earlier than queue_seconds,
+            so request waiting in several limiters doesn't wait longer than one of them allows
+        """
+        await self._acquire(deadline)
+        start_time = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.average_seconds += (time.monotonic() - start_time - self.average_seconds) * self._average_weight
+            self._release()
+
+    def expected_wait_seconds(self) -> float:
+        return (len(self._waiters) + 1) / self.limit * self.average_seconds
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.expected_wait_seconds()))
+
+    def stats(self) -> dict:
+        return {
+            'active': self.active,
+            'waiting': len(self._waiters),
+            'rejected': self.rejected,
+        }
+
+    async def _acquire(self, deadline: float=None):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+
+        timeout = self.queue_seconds
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+
+        if len(self._waiters) >= self.queue_size or self.expected_wait_seconds() > timeout:
+            self.rejected += 1
+            raise ResourceOverloadedException(self.retry_after())
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except BaseException as ex:
+            if waiter.done() and not waiter.cancelled():
+                # slot was given at the same time as waiting was interrupted
+                self._release()
+            else:
+                waiter.cancel()
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+            if isinstance(ex, asyncio.TimeoutError):
+                self.rejected += 1
+                raise ResourceOverloadedException(self.retry_after())
+
+            raise
+
+    def _release(self):
+        # slot is passed to the first waiter, so the number of active requests doesn't change
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+        self.active -= 1
@@ -0,0 +1,85 @@
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def lttb_indices(xs: list, ys: list, threshold: int) -> list:
+    """
+    Largest-Triangle-Three-Buckets downsampling, selects points which preserve shape of the series
+
+    :param xs: x coordinates sorted in ascending order
+    :param ys: y coordinates, None is treated as 0
+    :param threshold: number of points to select
+    :return: sorted indices of selected points
+    """
+    length = len(xs)
+    if threshold >= length or threshold < 3:
+        return list(range(length))
+
+    ys = [float(y) if y is not None else 0.0 for y in ys]
+
+    if numpy is not None:
+        return _lttb_indices_numpy(numpy.asarray(xs, dtype=float), numpy.asarray(ys, dtype=float), threshold)
+
+    return _lttb_indices_python([float(x) for x in xs], ys, threshold)
+
+
+def _lttb_indices_python(xs: list, ys: list, threshold: int) -> list:
+    length = len(xs)
+    every = (length - 2) / (threshold - 2)
+    result = [0]
+    a = 0
+
+    for i in range(threshold - 2):
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, length)
+        avg_x = sum(xs[next_start:next_end]) / (next_end - next_start)
+        avg_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = xs[a], ys[a]
+
+        max_area = -1.0
+        max_index = start
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay))
+            if area > max_area:
+                max_area = area
+                max_index = j
+
+        result.append(max_index)
+        a = max_index
+
+    result.append(length - 1)
+
+    return result
+
+
+def _lttb_indices_numpy(xs, ys, threshold: int) -> list:
+    length = len(xs)
+    every = (length - 2) / (threshold - 2)
+    bounds = (numpy.arange(threshold - 1) * every).astype(int) + 1
+    bounds[-1] = length - 1
+
+    # averages of every bucket are computed at once, the last point is the last "bucket"
+    sums_x = numpy.add.reduceat(xs[:length - 1], bounds[:-1])
+    sums_y = numpy.add.reduceat(ys[:length - 1], bounds[:-1])
+    counts = numpy.diff(bounds)
+    avg_x = numpy.append(sums_x / counts, xs[-1])
+    avg_y = numpy.append(sums_y / counts, ys[-1])
+
+    result = [0]
+    a = 0
+
+    for i in range(threshold - 2):
+        start, end = bounds[i], bounds[i + 1]
+        ax, ay = xs[a], ys[a]
+        areas = numpy.abs((ax - avg_x[i + 1]) * (ys[start:end] - ay) - (ax - xs[start:end]) * (avg_y[i + 1] - ay))
+        a = int(start) + int(numpy.argmax(areas))
+        result.append(a)
+
+    result.append(length - 1)
+
+    return result
@@ -28,3 +28,16 @@ class SerializationError(RestyCornException):
 
 class SQLRequestConstructorException(RestyCornException):
     pass
+
+
+class ResourceOverloadedException(ResourceException):
+    def __init__(self, retry_after: int):
+        """
+        :param retry_after: seconds after which request is likely to be processed
+        """
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class QueryTimeoutException(ResourceException):
+    pass
@@ -0,0 +1,132 @@
+import re
+
+from .exceptions import ParamsValidationException
+
+
+class FilterParser:
+    """
+    Parses filter expressions like this
+        user_id in (1, 2, 3) && timestamp between 1514764800 and 1517443200 && username != 'admin'
+    to tuple of conditions (field, operator, value), value is a tuple for "in" and "between".
+    Values are strings, quoted strings may contain any characters, quotes inside them are escaped by backslash.
+
+    Operators: =, !=, >, <, >=, <=, in, between
+    """
+
+    _token_regex = re.compile(r"""
+        \s*(?:
+            (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+            |(?P<operator>!=|>=|<=|=|>|<|\(|\)|,|&&)
+            |(?P<word>[^\s'"!=<>(),&]+)
+        )
+    """, re.VERBOSE)
+    _escape_regex = re.compile(r'\\(.)')
+
+    # operators written as words, they're case insensitive
+    _word_operators = ('in', 'between', )
+
+    def __init__(self, max_size: int=1024):
+        """
+        :param max_size: maximum number of cached parsed expressions
+        """
+        self.max_size = max_size
+        self._parsed = {}
+
+    def parse(self, expression: str) -> tuple:
+        result = self._parsed.get(expression)
+
+        if result is None:
+            result = self._parse(expression)
+
+            if len(self._parsed) >= self.max_size:
+                self._parsed.clear()
+
+            self._parsed[expression] = result
+
+        return result
+
+    def _parse(self, expression: str) -> tuple:
+        tokens = self._tokenize(expression)
+        position = 0
+        result = []
+
+        while True:
+            if position + 2 > len(tokens) or tokens[position][0] != 'word':
+                raise ParamsValidationException("Bad filter expression")
+
+            field, operator = tokens[position:position + 2]
+            position += 2
+
+            if operator[0] == 'word' and operator[1].lower() in self._word_operators:
+                operator = operator[1].lower()
+            elif operator[0] == 'operator' and operator[1] in ('=', '!=', '>', '<', '>=', '<='):
+                operator = operator[1]
+            else:
+                raise ParamsValidationException("Bad filter expression")
+
+            if operator == 'in':
+                value, position = self._parse_list(tokens, position)
+            elif operator == 'between':
+                low, position = self._parse_value(tokens, position)
+                if position >= len(tokens) or tokens[position][0] != 'word' or tokens[position][1].lower() != 'and':
+                    raise ParamsValidationException("Bad filter expression")
+                high, position = self._parse_value(tokens, position + 1)
+                value = (low, high)
+            else:
+                value, position = self._parse_value(tokens, position)
+
+            result.append((field[1], operator, value))
+
+            if position == len(tokens):
+                return tuple(result)
+
+            if tokens[position] != ('operator', '&&'):
+                raise ParamsValidationException("Bad filter expression")
+
+            position += 1
+
+    def _parse_list(self, tokens: list, position: int) -> tuple:
+        if position >= len(tokens) or tokens[position] != ('operator', '('):
+            raise ParamsValidationException("Bad filter expression")
+
+        values = []
+        while True:
+            value, position = self._parse_value(tokens, position + 1)
+            values.append(value)
+
+            if position >= len(tokens):
+                raise ParamsValidationException("Bad filter expression")
+
+            if tokens[position] == ('operator', ')'):
+                return tuple(values), position + 1
+
+            if tokens[position] != ('operator', ','):
+                raise ParamsValidationException("Bad filter expression")
+
+    def _parse_value(self, tokens: list, position: int) -> tuple:
+        if position >= len(tokens):
+            raise ParamsValidationException("Bad filter expression")
+
+        kind, value = tokens[position]
+
+        if kind == 'string':
+            return self._escape_regex.sub(r'\1', value[1:-1]), position + 1
+        if kind == 'word':
+            return value, position + 1
+
+        raise ParamsValidationException("Bad filter expression")
+
+    def _tokenize(self, expression: str) -> list:
+        tokens = []
+        position = 0
+        expression = expression.rstrip()
+
+        while position < len(expression):
+            match = self._token_regex.match(expression, position)
+            if match is None:
+                raise ParamsValidationException("Bad filter expression")
+
+            tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            position = match.end()
+
+        return tokens
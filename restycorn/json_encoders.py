@@ -0,0 +1,74 @@
+import datetime
+import decimal
+import json
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _default(value):
+    """
+    Converts values returned by asyncpg which json libraries don't support
+    """
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if hasattr(value, 'tolist'):
+        # numpy arrays and scalars
+        return value.tolist()
+
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def stdlib_encoder(value) -> bytes:
+    return json.dumps(value, default=_default).encode()
+
+
+def orjson_encoder(value) -> bytes:
+    return orjson.dumps(value, default=_default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+def ujson_encoder(value) -> bytes:
+    return ujson.dumps(value, default=_default, ensure_ascii=False).encode()
+
+
+def get_json_encoder(encoder='json'):
+    """
+    Returns function encoding value to json bytes
+
+    :param encoder: one of "json", "orjson", "ujson", "auto" (the fastest installed one) or function itself
+    :return:
+    """
+    if callable(encoder):
+        return encoder
+
+    if encoder == 'auto':
+        if orjson is not None:
+            return orjson_encoder
+        if ujson is not None:
+            return ujson_encoder
+        return stdlib_encoder
+
+    if encoder == 'json':
+        return stdlib_encoder
+    if encoder == 'orjson':
+        if orjson is None:
+            raise ValueError("orjson is not installed")
+        return orjson_encoder
+    if encoder == 'ujson':
+        if ujson is None:
+            raise ValueError("ujson is not installed")
+        return ujson_encoder
+
+    raise ValueError("Unknown json encoder \"{}\"".format(encoder))
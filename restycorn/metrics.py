@@ -0,0 +1,155 @@
+import bisect
+
+
+class Histogram:
+    # upper bounds of buckets in seconds
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, )
+
+    def __init__(self, buckets: tuple=default_buckets):
+        self.buckets = buckets
+        # the last one is +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class ResourceMetrics:
+    """
+    Metrics of one resource. Recording only increments numbers in dicts, names of metrics are formatted
+    only when registry is rendered
+    """
+
+    # kind of histogram -> its name in registry and description
+    histograms = {
+        'request': ('restycorn_request_seconds', 'Time of processing request in seconds'),
+        'db': ('restycorn_db_seconds', 'Time of database queries in seconds'),
+        'serialization': ('restycorn_serialization_seconds', 'Time of serializing rows in seconds'),
+        'encode': ('restycorn_encode_seconds', 'Time of encoding response in seconds'),
+    }
+
+    def __init__(self):
+        # (method name, status) -> number of requests
+        self.requests = {}
+        # (kind, method name) -> Histogram
+        self.times = {}
+        self.in_flight = 0
+
+    def observe_request(self, method_name: str, status: int, seconds: float):
+        key = (method_name, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        self.observe('request', method_name, seconds)
+
+    def observe(self, kind: str, method_name: str, seconds: float):
+        histogram = self.times.get((kind, method_name))
+        if histogram is None:
+            histogram = self.times[(kind, method_name)] = Histogram()
+
+        histogram.observe(seconds)
+
+
+class MetricsRegistry:
+    """
+    Renders metrics of resources, their caches, limiters and connection pools in Prometheus text format.
+    Metrics are kept in memory of process, so every worker has its own ones
+    """
+
+    def __init__(self):
+        # resource name -> ResourceRequestHandler
+        self.handlers = {}
+        # functions returning dict of pool name -> dict of its stats
+        self.pool_stats = []
+        # functions returning number of requests waiting for connection of any pool
+        self.connection_waiting = []
+
+    def add_resource(self, resource_name: str, handler):
+        self.handlers[resource_name] = handler
+
+    def add_pool_stats(self, get_stats):
+        self.pool_stats.append(get_stats)
+
+    def add_connection_waiting(self, get_waiting):
+        self.connection_waiting.append(get_waiting)
+
+    def render(self) -> str:
+        lines = []
+
+        self._header(lines, 'restycorn_requests_total', 'counter', 'Number of processed requests')
+        for resource_name, handler in self.handlers.items():
+            for (method_name, status), count in handler.metrics.requests.items():
+                lines.append('restycorn_requests_total{} {}'.format(
+                    self._labels(resource=resource_name, method=method_name, status=status), count))
+
+        self._header(lines, 'restycorn_in_flight_requests', 'gauge', 'Number of requests being processed')
+        for resource_name, handler in self.handlers.items():
+            lines.append('restycorn_in_flight_requests{} {}'.format(
+                self._labels(resource=resource_name), handler.metrics.in_flight))
+
+        for kind, (name, description) in ResourceMetrics.histograms.items():
+            self._header(lines, name, 'histogram', description)
+            for resource_name, handler in self.handlers.items():
+                for (histogram_kind, method_name), histogram in handler.metrics.times.items():
+                    if histogram_kind == kind:
+                        self._histogram(lines, name, histogram, resource=resource_name, method=method_name)
+
+        for stat, metric_type in (('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'),
+                                  ('size', 'gauge')):
+            name = 'restycorn_cache_{}'.format(stat) + ('_total' if metric_type == 'counter' else '')
+            self._header(lines, name, metric_type, 'Cache {}'.format(stat))
+            for resource_name, handler in self.handlers.items():
+                for cache_name, cache in handler.caches().items():
+                    stats = cache.stats()
+                    if stat in stats:
+                        lines.append('{}{} {}'.format(
+                            name, self._labels(resource=resource_name, cache=cache_name), stats[stat]))
+
+        for stat, metric_type in (('active', 'gauge'), ('waiting', 'gauge'), ('rejected', 'counter')):
+            name = 'restycorn_limiter_{}'.format(stat) + ('_total' if metric_type == 'counter' else '')
+            self._header(lines, name, metric_type, 'Requests {} by concurrency limiter'.format(stat))
+            for resource_name, handler in self.handlers.items():
+                for method_name, limiter in handler.limiters().items():
+                    lines.append('{}{} {}'.format(
+                        name, self._labels(resource=resource_name, method=method_name), limiter.stats()[stat]))
+
+        pools = {}
+        for get_stats in self.pool_stats:
+            pools.update(get_stats())
+
+        for stat, description in (('size', 'Number of connections of pool'),
+                                  ('idle', 'Number of idle connections of pool')):
+            name = 'restycorn_pool_{}'.format(stat)
+            self._header(lines, name, 'gauge', description)
+            for pool_name, stats in pools.items():
+                if stat in stats:
+                    lines.append('{}{} {}'.format(name, self._labels(pool=pool_name), stats[stat]))
+
+        # requests wait for any pool, so number of them isn't labeled with pool
+        self._header(lines, 'restycorn_pool_waiting', 'gauge', 'Number of requests waiting for connection')
+        if self.connection_waiting:
+            lines.append('restycorn_pool_waiting {}'.format(
+                sum(get_waiting() for get_waiting in self.connection_waiting)))
+
+        return '\n'.join(lines) + '\n'
+
+    def _histogram(self, lines: list, name: str, histogram: Histogram, **labels):
+        count = 0
+        for bound, bucket_count in zip(histogram.buckets + ('+Inf', ), histogram.counts):
+            count += bucket_count
+            lines.append('{}_bucket{} {}'.format(name, self._labels(**dict(labels, le=bound)), count))
+
+        lines.append('{}_sum{} {}'.format(name, self._labels(**labels), histogram.sum))
+        lines.append('{}_count{} {}'.format(name, self._labels(**labels), count))
+
+    @staticmethod
+    def _header(lines: list, name: str, metric_type: str, description: str):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+
+    @staticmethod
+    def _labels(**labels) -> str:
+        return '{' + ','.join(
+            '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in labels.items()
+        ) + '}'
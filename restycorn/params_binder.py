@@ -0,0 +1,86 @@
+import inspect
+
+from .exceptions import ParamsValidationException
+from .restycorn_types import uint
+
+
+class ParamsBinder:
+    """
+    Validates params of request and converts them to types of annotations of resource method.
+    Signature of method is inspected once, so binding params is a few dict and set operations
+    """
+
+    def __init__(self, func):
+        signature_params = inspect.signature(func).parameters
+
+        self.names = frozenset(signature_params)
+        # required params in order of signature to report the first missing one
+        self.required = tuple(
+            name for name, parameter_info in signature_params.items()
+            if parameter_info.default is inspect.Parameter.empty
+        )
+        # param name -> (annotation, converter), only for annotated params
+        self.converters = {}
+        self.defaults = {}
+
+        for name, parameter_info in signature_params.items():
+            annotation = parameter_info.annotation
+            if annotation is not inspect.Parameter.empty:
+                self.converters[name] = (annotation, self._get_converter(annotation), parameter_info.default is None)
+
+            if parameter_info.default is not inspect.Parameter.empty:
+                self.defaults[name] = parameter_info.default
+
+        # defaults are converted only once
+        self.defaults = self._convert(self.defaults)
+
+    def bind(self, params: dict) -> dict:
+        """
+        :param params: params of request
+        :return: all params of method with applied defaults and converted values
+        """
+        if not self.names.issuperset(params):
+            key = next(key for key in params if key not in self.names)
+            raise ParamsValidationException('key "{}" is not allowed here'.format(key))
+
+        if len(params) < len(self.names):
+            for name in self.required:
+                if name not in params:
+                    raise ParamsValidationException('param "{}" is required'.format(name))
+
+        result = dict(self.defaults)
+        result.update(self._convert(params))
+
+        return result
+
+    def _convert(self, params: dict) -> dict:
+        result = {}
+        for key, value in params.items():
+            converter = self.converters.get(key)
+            if converter is not None:
+                annotation, convert, none_allowed = converter
+                if type(value) is not annotation and not (none_allowed and value is None):
+                    try:
+                        value = convert(value)
+                    except ValueError:
+                        raise ParamsValidationException('key "{}" should be "{}" or type convertible to "{}"'.format(
+                            key, annotation, annotation))
+
+            result[key] = value
+
+        return result
+
+    @staticmethod
+    def _get_converter(annotation):
+        if annotation is uint:
+            return _to_uint
+
+        return annotation
+
+
+def _to_uint(value) -> uint:
+    # digits can't be negative, so python constructor of uint with its check is skipped
+    if type(value) is str and value.isdigit() and value.isascii():
+        return int.__new__(uint, value)
+
+    return uint(value)
@@ -1,9 +1,48 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+
 import asyncpg
+import asyncpgsa
+
+logger = logging.getLogger(__name__)
+
+
+class _Replica:
+    def __init__(self, connect_kwargs: dict):
+        self.connect_kwargs = connect_kwargs
+        self.pool = None
+        self.healthy = False
+        # replication lag in seconds, None if it's unknown
+        self.lag = None
+
+    def busy_connections(self) -> int:
+        return self.pool.get_size() - self.pool.get_idle_size()
 
 
 class _Postgresql:
+    # errors of connecting to server after which replica isn't used until the next successful health check
+    _connection_errors = (OSError, asyncio.TimeoutError, asyncpg.PostgresConnectionError,
+                          asyncpg.CannotConnectNowError, asyncpg.InterfaceError)
+
+    _lag_query = """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+        END
+    """
+
     def __init__(self):
         self.pool = None
+        self.replicas = []
+        self.balancing = 'least_busy'
+        self.max_replica_lag = 10.0
+        self.health_check_interval = 5.0
+        self._round_robin = itertools.count()
+        # number of requests waiting for connection of any pool, including one of asyncpgsa
+        self.waiting = 0
+        self._health_check_task = None
 
     async def get_pool(self):
         if self.pool is None:
@@ -11,13 +50,139 @@ class _Postgresql:
 
         return self.pool
 
-    async def connect(self, user, password, database, min_size, max_size):
-        self.pool = await asyncpg.create_pool(
-            user=user,
-            password=password,
-            database=database,
-            min_size=min_size,
-            max_size=max_size,
-        )
+    async def connect(self, user, password, database, min_size, max_size, replicas=None, balancing='least_busy',
+                      max_replica_lag=10.0, health_check_interval=5.0, **connect_kwargs):
+        """
+        Connects to primary server and its read replicas
+
+        :param replicas: list of dicts of asyncpg.create_pool params of replicas, like {'host': 'replica1'},
+            params which aren't passed are the same as primary's ones
+        :param balancing: how replica is chosen for read query, "least_busy" - one with
+            the least number of acquired connections, "round_robin" - replicas in turn
+        :param max_replica_lag: replica which replays changes of primary later than that is not used
+        :param health_check_interval: how often replication lag of replicas is checked in seconds
+        :param connect_kwargs: other params of asyncpg.create_pool, like host and port
+        """
+        if balancing not in ('least_busy', 'round_robin'):
+            raise ValueError("balancing should be \"least_busy\" or \"round_robin\"")
+
+        connect_kwargs.update(user=user, password=password, database=database, min_size=min_size, max_size=max_size)
+
+        self.pool = await asyncpg.create_pool(**connect_kwargs)
+        self.replicas = [_Replica(dict(connect_kwargs, **replica)) for replica in replicas or ()]
+        self.balancing = balancing
+        self.max_replica_lag = max_replica_lag
+        self.health_check_interval = health_check_interval
+
+        if self.replicas:
+            await self.check_replicas()
+            self._health_check_task = asyncio.ensure_future(self._check_replicas_periodically())
+
+    async def close(self):
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+            self._health_check_task = None
+
+        for replica in self.replicas:
+            if replica.pool is not None:
+                await replica.pool.close()
+
+        if self.pool is not None:
+            await self.pool.close()
+
+    def get_read_pool(self):
+        """
+        Returns pool of healthy replica chosen by balancing or pool of primary if there is no such replica
+        """
+        replica = self._choose_replica()
+
+        return replica.pool if replica is not None else self.pool
+
+    @contextlib.asynccontextmanager
+    async def acquire_read(self):
+        """
+        Acquires connection for read only queries, if replica can't give connection, primary is used
+        """
+        replica = self._choose_replica()
+        connection = None
+
+        if replica is not None:
+            try:
+                connection = await replica.pool.acquire()
+            except self._connection_errors:
+                replica.healthy = False
+
+        if connection is None:
+            async with self.pool.acquire() as connection:
+                yield connection
+            return
+
+        try:
+            yield connection
+        finally:
+            await replica.pool.release(connection)
+
+    async def check_replicas(self):
+        await asyncio.gather(*[self._check_replica(replica) for replica in self.replicas])
+
+    def stats(self) -> dict:
+        """
+        Returns stats of pools by their names, pool of asyncpgsa is primary one if db isn't connected
+        """
+        primary_pool = self.pool
+        if primary_pool is None and asyncpgsa.pg.initialized:
+            primary_pool = asyncpgsa.pg.pool
+
+        pools = {'primary': primary_pool}
+        pools.update(('replica_{}'.format(i), replica.pool) for i, replica in enumerate(self.replicas))
+
+        result = {
+            name: {'size': pool.get_size(), 'idle': pool.get_idle_size()}
+            for name, pool in pools.items() if pool is not None
+        }
+
+        for i, replica in enumerate(self.replicas):
+            result.setdefault('replica_{}'.format(i), {}).update(healthy=replica.healthy, lag=replica.lag)
+
+        return result
+
+    def _choose_replica(self):
+        replicas = [replica for replica in self.replicas if replica.healthy]
+        if not replicas:
+            return None
+
+        if self.balancing == 'round_robin':
+            return replicas[next(self._round_robin) % len(replicas)]
+
+        return min(replicas, key=_Replica.busy_connections)
+
+    async def _check_replicas_periodically(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            await self.check_replicas()
+
+    async def _check_replica(self, replica: _Replica):
+        try:
+            if replica.pool is None:
+                replica.pool = await asyncpg.create_pool(**replica.connect_kwargs)
+
+            async with replica.pool.acquire(timeout=self.health_check_interval) as connection:
+                lag = await connection.fetchval(self._lag_query, timeout=self.health_check_interval)
+        except (asyncpg.PostgresError, ) + self._connection_errors as ex:
+            if replica.healthy:
+                logger.warning('Replica %s is unavailable: %s', replica.connect_kwargs.get('host'), ex)
+
+            replica.healthy = False
+            replica.lag = None
+            return
+
+        # replay timestamp is null if replica hasn't replayed anything yet
+        replica.lag = float(lag) if lag is not None else None
+        healthy = replica.lag is not None and replica.lag <= self.max_replica_lag
+
+        if replica.healthy and not healthy:
+            logger.warning('Replica %s lags behind primary for %s seconds', replica.connect_kwargs.get('host'), lag)
+
+        replica.healthy = healthy
 
-db = _Postgresql()
\ No newline at end of file
+db = _Postgresql()
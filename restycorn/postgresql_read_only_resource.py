@@ -1,20 +1,77 @@
-from pikabot_graphs import settings
 from .postgresql import db
 from .base_resource import BaseResource
-from .exceptions import MethodIsNotAllowedException, ParamsValidationException, ResourceItemDoesNotExistException
+from .downsampling import lttb_indices
+from .exceptions import MethodIsNotAllowedException, ParamsValidationException, ResourceItemDoesNotExistException, \
+    QueryTimeoutException
+from .filter_parser import FilterParser
 from .postgresql_serializer import PostgreSQLSerializer
+from .query_log import default_query_log
+from .request_cache import RequestCache
 from .restycorn_types import uint
+from .row_stream import RowStream
+from .statement_cache import StatementCache
 
+import asyncio
 import asyncpgsa
 import asyncpg
+import base64
+import binascii
+import contextlib
+import datetime
+import json
+import logging
 import re
 import sqlalchemy
 import time
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg
+
+logger = logging.getLogger(__name__)
 
 
 class PostgreSQLReadOnlyResource(BaseResource):
     def __init__(self, sqlalchemy_table, fields, id_field, order_by, filter_by=None, search_by=None, paginated=True,
-                 page_size=10, join=None):
+                 page_size=10, join=None, streamed=False, stream_chunk_size=1000, time_field=None, value_fields=None,
+                 max_batch_size=100, embed=None, count_strategy='exact', count_cache_seconds=60, search_mode='ilike',
+                 search_vector_field=None, search_config='simple', slow_query_seconds=0.5, query_log=None,
+                 query_timeout=None):
+        """
+        :param streamed: if True and resource is not paginated, list reads rows with server side cursor
+            and sends them to client in chunks of stream_chunk_size items
+        :param time_field: field with time of time series entry,
+            required to use bucket, agg and max_points params of list
+        :param value_fields: fields aggregated when bucket is passed, all fields except time_field by default.
+            The rest of fields is grouped by
+        :param max_batch_size: maximum number of ids which can be requested at once by list's ids param
+        :param embed: dict of lists of child items added to every item, like this
+            {
+                'score_entries': {
+                    'table': scoreentry_table,
+                    'foreign_key': 'scoreboard_entry_id',  # column of child table
+                    'fields': ('username', 'score', ),
+                    'parent_field': 'id',  # column of this table, id_field by default
+                    'order_by': 'score',  # optional, may start with '-'
+                },
+            }
+            Children of all items of the page are fetched by one query
+        :param count_strategy: how list counts items when count=true is passed:
+            "exact" - count(*) query, its result is cached for count_cache_seconds;
+            "estimated" - planner's estimation from pg_class.reltuples or EXPLAIN of filtered query;
+            "window" - count(*) OVER() is selected with the page of items in the same query
+        :param search_mode: how search_text is matched with search_by fields:
+            "ilike" - ILIKE '%text%', needs trigram index to not scan the whole table;
+            "prefix" - LIKE 'text%', case sensitive, can use btree index with text_pattern_ops;
+            "trigram" - pg_trgm similarity operator %, items are ranked by similarity;
+            "tsvector" - full text search with plainto_tsquery, items are ranked by ts_rank.
+            Ranking is applied only if order_by isn't passed. See search_index_ddl for indexes of every mode
+        :param search_vector_field: precomputed tsvector column used by "tsvector" mode,
+            by default to_tsvector of search_by fields is computed on the fly
+        :param search_config: text search configuration of "tsvector" mode
+        :param slow_query_seconds: queries taking longer than that are written to query_log, None to not write them
+        :param query_log: QueryLog of slow queries, default one writes them to "restycorn.query_log" logger
+        :param query_timeout: maximum time of query in seconds, query is cancelled on server when it's exceeded
+            and request fails with 504, None to not limit it
+        """
         self.table = sqlalchemy_table
         self.fields = fields
         self.order_by_fields = order_by
@@ -22,15 +79,117 @@ class PostgreSQLReadOnlyResource(BaseResource):
         self.search_by_fields = search_by if search_by is not None else []
         self.filter_by_fields = filter_by if filter_by is not None else []
         self.serializer = PostgreSQLSerializer(self.fields)
+        # names of fields requested by client -> serializer of these fields
+        self._serializers = {self.serializer.names: self.serializer}
         self.paginated = paginated
         self.page_size = page_size
         self.join = join
+        self.streamed = streamed
+        self.stream_chunk_size = stream_chunk_size
+        self.time_field = time_field
+        if value_fields is None:
+            value_fields = tuple(field for field in self.serializer.fields if field != time_field)
+        self.value_fields = value_fields
+        self.max_batch_size = max_batch_size
+        self.embed = []
+        for name, options in (embed or {}).items():
+            self.embed.append((
+                name,
+                options['table'],
+                options['foreign_key'],
+                options.get('parent_field', id_field),
+                PostgreSQLSerializer(options['fields']),
+                options.get('order_by'),
+            ))
+
+        if time_field is not None and time_field not in self.serializer.fields:
+            raise ValueError("time_field should be one of fields")
+
+        if count_strategy not in ('exact', 'estimated', 'window'):
+            raise ValueError("count_strategy should be one of \"exact\", \"estimated\", \"window\"")
+        self.count_strategy = count_strategy
+        self.count_cache = RequestCache(max_size=1024, ttl_seconds=count_cache_seconds, max_bytes=1024 * 1024)
+
+        if search_mode not in self._search_modes:
+            raise ValueError("search_mode should be one of {}".format(', '.join(self._search_modes)))
+        if not re.fullmatch('[a-z_]+', search_config):
+            raise ValueError("Bad search_config")
+        self.search_mode = search_mode
+        self.search_vector_field = search_vector_field
+        self.search_config = search_config
+
+        self.slow_query_seconds = slow_query_seconds
+        self.query_log = query_log if query_log is not None else default_query_log
+        self.query_timeout = query_timeout
+
+        self.filter_parser = FilterParser()
+        self.statement_cache = StatementCache()
+
+    async def list(self, page: uint=0, order_by: str=None, search_text: str=None, filter: str=None, count: bool=False,
+                   cursor: str=None, format: str=None, bucket: uint=None, agg: str=None, max_points: uint=None,
+                   fields: str=None, ids: str=None):
+        """
+        Returns page of items. If cursor is passed (empty value means the first page), keyset pagination is used
+        instead of offset: items are returned with next_cursor which should be passed to get the next page.
+        If format is "columnar", items are returned as dict of lists of fields' values.
+
+        For time series resources items can be grouped to buckets of time_field of size bucket with agg
+        (avg, min, max or last) of value fields and downsampled to max_points items preserving shape of the series.
+
+        filter is list of conditions joined by "&&" like "user_id in (1, 2) && timestamp between 1514764800 and 1517443200",
+        operators are =, !=, >, <, >=, <=, in and between, values may be quoted.
+
+        fields is comma separated list of fields to return, all fields are returned by default.
+
+        ids is comma separated list of ids, items with these ids are returned as dict by id
+        with null for ids which don't exist.
+        """
+        if format is not None and format not in ('rows', 'columnar'):
+            raise ParamsValidationException("Unknown format")
+
+        serializer = self._get_serializer(fields)
+
+        if ids is not None:
+            if page or count or any(param is not None for param in (
+                    order_by, search_text, filter, cursor, format, bucket, agg, max_points)):
+                raise ParamsValidationException("ids can be combined only with fields")
+
+            return await self._get_many(ids, serializer)
+
+        if (bucket is not None or max_points is not None) and self.time_field is None:
+            raise ParamsValidationException("It's not allowed to aggregate this resource")
+
+        if bucket is not None:
+            if not bucket:
+                raise ParamsValidationException("bucket should be positive")
+            if count or cursor is not None:
+                raise ParamsValidationException("It's not allowed to use bucket with count or cursor")
+            if agg is None:
+                agg = 'avg'
+            if agg not in self._aggregate_functions:
+                raise ParamsValidationException("Unknown aggregate function")
+        elif agg is not None:
+            raise ParamsValidationException("agg can be used only with bucket")
+
+        if max_points is not None:
+            if max_points < 3:
+                raise ParamsValidationException("max_points should be at least 3")
+            if self.time_field not in serializer.fields or self.value_fields[0] not in serializer.fields:
+                raise ParamsValidationException("Fields of time series should be selected to use max_points")
+
+        if cursor is not None and page:
+            raise ParamsValidationException("It's not allowed to use page and cursor together")
+
+        search_text = search_text.strip() if search_text else None
+        # relevance is more important than default ordering, but not than requested one
+        ranked = bool(search_text) and order_by is None and cursor is None and bucket is None \
+            and self.search_mode in ('trigram', 'tsvector')
 
-    async def list(self, page: uint=0, order_by: str=None, search_text: str=None, filter: str=None, count: bool=False):
         if order_by is None:
             order_by = self.order_by_fields[0]
 
         order_by = order_by.strip()
+        order_by_param = order_by
 
         if (order_by[1:] if order_by.startswith('-') else order_by) not in self.order_by_fields:
             raise ParamsValidationException("It's not allowed to sort by this field")
@@ -42,118 +201,833 @@ class PostgreSQLReadOnlyResource(BaseResource):
             order_field_name = order_by
             descend_ordering = False
 
-        order_by = getattr(self.table.c, order_field_name)
-        if descend_ordering:
-            order_by = sqlalchemy.desc(order_by)
+        keyset = cursor is not None and not count
+        cursor_values = self._decode_cursor(cursor, order_by_param, order_field_name) if keyset and cursor else None
 
-        # sql_request = self.table.select()
-        if count:
-            sql_request = sqlalchemy.select([sqlalchemy.func.count()])
+        if search_text and self.search_mode in ('ilike', 'prefix'):
+            search_text = search_text.replace('!', '!!').replace("%", "!%").replace("_", "!_") + '%'
+            if self.search_mode == 'ilike':
+                search_text = '%' + search_text
+
+        filters = self._parse_filters(filter) if filter else ()
+
+        if max_points is not None:
+            for field_name, operator, value in filters:
+                # series of different values of field which isn't returned can't be downsampled separately
+                several_values = operator != '=' and not (operator == 'in' and len(value) == 1)
+                if several_values and field_name != self.time_field and field_name not in serializer.fields:
+                    raise ParamsValidationException(
+                        "Field \"{}\" should be selected to use max_points with several series".format(field_name))
+
+        params = {
+            'limit': self.page_size,
+            'offset': page * self.page_size,
+            'search_text': search_text,
+            'bucket': bucket,
+        }
+        for i, (_, operator, value) in enumerate(filters):
+            if operator == 'between':
+                params['filter_{}_0'.format(i)], params['filter_{}_1'.format(i)] = value
+            else:
+                params['filter_{}'.format(i)] = value
+
+        if cursor_values is not None:
+            params['cursor_order'], params['cursor_id'] = cursor_values
+
+        filters = tuple((field_name, operator) for field_name, operator, _ in filters)
+
+        # with window strategy count is selected together with items, it's impossible for keyset pagination
+        # because rows before cursor are filtered out
+        window_count = count and self.count_strategy == 'window' and cursor is None
+        if count and not window_count:
+            return [], await self._count(bool(search_text), filters, params, self.count_strategy)
+
+        shape = (
+            window_count, order_field_name, descend_ordering, keyset, cursor_values is not None, bool(search_text),
+            filters, agg, serializer.names, ranked, cursor_values is not None and cursor_values[0] is None,
+        )
+        statement = self.statement_cache.get(('list', ) + shape, lambda: self._build_list_query(*shape))
+        args = statement.bind(params)
+
+        if self.is_streamed('list', {'count': count, 'cursor': cursor, 'format': format, 'max_points': max_points}):
+            return RowStream(self._stream_items(('list', ) + shape, statement, args, serializer, agg))
+
+        items = await self._query('list', ('list', ) + shape, statement, args)
+
+        extra = {}
+
+        if window_count:
+            if items:
+                extra = {
+                    'count': items[0]['_total_count'],
+                    'count_strategy': 'window',
+                }
+            else:
+                # page is out of range, so the total isn't known
+                extra = await self._count(bool(search_text), filters, params, 'exact')
+
+        if max_points is not None:
+            items = self._downsample(items, max_points, serializer)
+
+        start_time = time.perf_counter()
+        if format == 'columnar':
+            result = serializer.serialize_columnar(items)
         else:
-            sql_request = sqlalchemy.select(['*'])
+            result = serializer.serialize_many(items)
+        self._observe('serialization', 'list', start_time)
 
-        select_table = self.table
+        if self.embed and agg is None:
+            await self._add_embedded_items(items, result)
 
-        if self.join is not None:
-            select_table = select_table.join(self.join[0], self.join[1])
+        if cursor is not None:
+            next_cursor = None
+            if self.paginated and len(items) == self.page_size:
+                next_cursor = self._encode_cursor(
+                    order_by_param, items[-1]['_cursor_order'], items[-1]['_cursor_id'])
+
+            extra['next_cursor'] = next_cursor
+
+        if extra:
+            return result, extra
+
+        return result
+
+    async def _count(self, search: bool, filters: tuple, params: dict, strategy: str) -> dict:
+        if strategy == 'estimated':
+            return {
+                'count': await self._estimate_count(search, filters, params),
+                'count_strategy': 'estimated',
+            }
 
-        sql_request = sql_request.select_from(select_table)
+        shape = ('count', search, filters, False)
+        statement = self.statement_cache.get(shape, lambda: self._build_count_query(search, filters))
+        args = statement.bind(params)
 
-        if search_text:
-            search_text = search_text.strip()
-            search_text = \
-                '%' + search_text.replace('!', '!!').replace("%", "!%").replace("_", "!_").replace("[", "![") + '%'
+        cache_key = (statement.sql, tuple(args))
+        count = self.count_cache.get(cache_key)
 
-            conditions = []
-            for search_field in self.search_by_fields:
-                conditions.append(getattr(self.table.c, search_field).ilike(search_text))
+        if count is None:
+            count = await self._query('list', shape, statement, args, 'fetchval')
+
+            self.count_cache.set(cache_key, count, 64)
+
+        return {
+            'count': count,
+            'count_strategy': 'exact',
+        }
+
+    async def _estimate_count(self, search: bool, filters: tuple, params: dict) -> int:
+        if not search and not filters:
+            with self._timeout_errors_handled():
+                async with self._acquire() as connection:
+                    count = await connection.fetchval(
+                        'SELECT reltuples::bigint FROM pg_class WHERE oid = $1::regclass', self.table.fullname,
+                        timeout=self.query_timeout)
+
+            # reltuples is -1 if table has never been analyzed
+            return max(count or 0, 0)
+
+        statement = self.statement_cache.get(
+            ('count', search, filters, True),
+            lambda: self._build_count_query(search, filters, rows=True),
+        )
 
-            sql_request = sql_request.where(sqlalchemy.or_(*conditions))
+        with self._timeout_errors_handled():
+            async with self._acquire() as connection:
+                plan = await connection.fetchval('EXPLAIN (FORMAT JSON) ' + statement.sql, *statement.bind(params),
+                                                 timeout=self.query_timeout)
 
-        if filter:
-            for expr in filter.split('&&'):
-                match = re.match('([a-zA-Z0-9_]+)\s*?([><=])\s*?([a-zA-Z0-9_]+)', expr.strip())
-                if not match:
-                    raise ParamsValidationException("Bad filter expression")
+        if isinstance(plan, str):
+            plan = json.loads(plan)
 
-                field, operator, value = match.groups()
+        return int(plan[0]['Plan']['Plan Rows'])
 
-                if field not in self.filter_by_fields:
-                    raise ParamsValidationException("It's not allowed to filter by this field")
+    @staticmethod
+    @contextlib.asynccontextmanager
+    async def _acquire():
+        """
+        Acquires connection for read queries, from replica if restycorn's db is connected with them,
+        from pool of asyncpgsa if db isn't connected
+        """
+        async with contextlib.AsyncExitStack() as stack:
+            db.waiting += 1
+            try:
+                connection = await stack.enter_async_context(
+                    asyncpgsa.pg.pool.acquire() if db.pool is None else db.acquire_read())
+            finally:
+                db.waiting -= 1
 
-                if operator not in self.filter_by_fields[field]:
-                    raise ParamsValidationException("It's not allowed to filter by this field using this operator")
+            yield connection
 
-                field = getattr(self.table.c, field)
+    async def _query(self, method_name: str, shape: tuple, statement, args: list, fetch_method: str='fetch',
+                     connection=None):
+        """
+        Makes query, records its time to metrics and writes it to query log if it's slow
 
-                try:
-                    value = field.type.python_type(value)
-                except ValueError:
-                    raise ParamsValidationException("Bad value for filter by field \"{}\"".format(field))
+        :param shape: key of statement in statement cache
+        :param fetch_method: method of connection returning result, like fetch or fetchrow
+        :param connection: already acquired connection, new one is acquired from pool if it's None
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('request: "%s" params: "%s"', statement.sql, args)
+
+        start_time = time.perf_counter()
+        with self._timeout_errors_handled():
+            async with contextlib.AsyncExitStack() as stack:
+                if connection is None:
+                    connection = await stack.enter_async_context(self._acquire())
+
+                result = await getattr(connection, fetch_method)(statement.sql, *args, timeout=self.query_timeout)
+
+        self._record_query(method_name, shape, statement, args, time.perf_counter() - start_time)
+
+        return result
+
+    def _record_query(self, method_name: str, shape: tuple, statement, args: list, seconds: float):
+        """
+        Records time of query to metrics and writes query to query log if it's slow
+        """
+        if self.metrics is not None:
+            self.metrics.observe('db', method_name, seconds)
+
+        if self.slow_query_seconds is not None and seconds > self.slow_query_seconds:
+            self.query_log.record(self.table.name, method_name, shape, statement.sql, args, seconds,
+                                  lambda: self._explain(statement.sql, args))
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _timeout_errors_handled():
+        """
+        Raises QueryTimeoutException if query exceeded query_timeout of asyncpg
+        or was cancelled by statement_timeout of server
+        """
+        try:
+            yield
+        except (asyncio.TimeoutError, asyncpg.QueryCanceledError) as ex:
+            raise QueryTimeoutException() from ex
+
+    async def _explain(self, sql: str, args: list):
+        async with self._acquire() as connection:
+            return await connection.fetchval('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, *args)
+
+    def caches(self) -> dict:
+        return {
+            'statement': self.statement_cache,
+            'count': self.count_cache,
+        }
+
+    def _observe(self, kind: str, method_name: str, start_time: float) -> float:
+        """
+        Records time since start_time to metrics
+
+        :return: current time
+        """
+        now = time.perf_counter()
+        if self.metrics is not None:
+            self.metrics.observe(kind, method_name, now - start_time)
+
+        return now
+
+    def is_streamed(self, method_name: str, params: dict) -> bool:
+        return self.streamed and not self.paginated and method_name == 'list' \
+            and not params.get('count') and params.get('cursor') is None and params.get('format') != 'columnar' \
+            and params.get('max_points') is None
+
+    async def _stream_items(self, shape: tuple, statement, args, serializer: PostgreSQLSerializer, agg: str=None):
+        """
+        Yields serialized chunks of rows read with cursor. Time of query is the sum of time of cursor's fetches,
+        time of sending chunks to client isn't included
+
+        :param agg: aggregate function of buckets, aggregated rows have no children to embed
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('request: "%s" params: "%s"', statement.sql, args)
+
+        async with self._acquire() as connection:
+            async with connection.transaction():
+                start_time = time.perf_counter()
+                with self._timeout_errors_handled():
+                    cursor = await connection.cursor(statement.sql, *args, timeout=self.query_timeout)
+                seconds = time.perf_counter() - start_time
+
+                while True:
+                    start_time = time.perf_counter()
+                    with self._timeout_errors_handled():
+                        items = await cursor.fetch(self.stream_chunk_size, timeout=self.query_timeout)
+                    seconds += time.perf_counter() - start_time
+
+                    last_chunk = len(items) < self.stream_chunk_size
+                    if last_chunk:
+                        # recorded before the last chunk is sent, client may close stream after getting it
+                        self._record_query('list', shape, statement, args, seconds)
+
+                    if items:
+                        result = serializer.serialize_many(items)
+                        if self.embed and agg is None:
+                            # waiting for the second connection while holding this one would deadlock the pool
+                            # when all of its connections are held by streams
+                            await self._add_embedded_items(items, result, connection)
+
+                        yield result
+
+                    if last_chunk:
+                        break
+
+    def _downsample(self, items: list, max_points: int, serializer: PostgreSQLSerializer) -> list:
+        """
+        Downsamples every series to max_points separately. Series are told apart by selected fields
+        which are neither time nor value ones, the same ones bucket groups by
+        """
+        key_names = [
+            name for field, name in serializer.fields.items()
+            if field != self.time_field and field not in self.value_fields
+        ]
+
+        # key of series -> indices of its items
+        series = {}
+        for i, item in enumerate(items):
+            series.setdefault(tuple(item[name] for name in key_names), []).append(i)
+
+        indices = []
+        for series_indices in series.values():
+            indices += [series_indices[i] for i in self._lttb_indices([items[i] for i in series_indices], max_points)]
+
+        return [items[i] for i in sorted(indices)]
+
+    def _lttb_indices(self, items: list, max_points: int) -> list:
+        time_values = [item[self.serializer.fields[self.time_field]] for item in items]
+        if time_values and isinstance(time_values[0], datetime.datetime):
+            time_values = [value.timestamp() for value in time_values]
+
+        value_name = self.serializer.fields[self.value_fields[0]]
+
+        return lttb_indices(time_values, [item[value_name] for item in items], max_points)
+
+    def canonical_params(self, method_name: str, params: dict) -> dict:
+        if method_name in ('list', 'get') and params.get('fields') is not None:
+            names = self._get_serializer(params['fields']).names
+            # all fields are the same as default ones
+            params['fields'] = ','.join(names) if names != self.serializer.names else None
+
+        return params
+
+    def _get_serializer(self, fields: str=None) -> PostgreSQLSerializer:
+        """
+        Returns serializer of fields requested by client
+
+        :param fields: comma separated names of fields, None means all fields
+        :return:
+        """
+        if fields is None:
+            return self.serializer
+
+        names = set(field.strip() for field in fields.split(','))
+        for name in names:
+            if name not in self.serializer.names:
+                raise ParamsValidationException("It's not allowed to select field \"{}\"".format(name))
+
+        # configured order of fields, so the same set of fields always has the same query
+        return self._serializer_of(tuple(name for name in self.serializer.names if name in names))
+
+    def _serializer_of(self, names: tuple) -> PostgreSQLSerializer:
+        """
+        Returns serializer of validated names of fields in configured order
+        """
+        serializer = self._serializers.get(names)
+        if serializer is None:
+            serializer = PostgreSQLSerializer([
+                field for field, name in zip(self.fields, self.serializer.names) if name in names
+            ])
+
+            # clients choose sets of fields, so their number is limited like in statement cache
+            if len(self._serializers) >= self._serializers_max_size:
+                self._serializers.clear()
+                self._serializers[self.serializer.names] = self.serializer
+
+            self._serializers[names] = serializer
+
+        return serializer
+
+    def _encode_cursor(self, order_by: str, order_value, id_value) -> str:
+        cursor = json.dumps([order_by, order_value, id_value], default=self._cursor_json, separators=(',', ':'))
+        return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+    @staticmethod
+    def _cursor_json(value) -> str:
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+
+        return str(value)
+
+    def _decode_cursor(self, cursor: str, order_by: str, order_field_name: str) -> tuple:
+        """
+        Returns values of order and id fields converted to types of their columns
+        """
+        try:
+            cursor_order_by, order_value, id_value = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+            raise ParamsValidationException("Bad cursor")
+
+        if cursor_order_by != order_by:
+            raise ParamsValidationException("Cursor was created for another ordering")
+
+        try:
+            return self._cursor_value(order_field_name, order_value), self._cursor_value(self.id_field, id_value)
+        except (ValueError, TypeError):
+            raise ParamsValidationException("Bad cursor")
 
-                if operator == '=':
-                    sql_request = sql_request.where(field == value)
-                elif operator == '>':
-                    sql_request = sql_request.where(field > value)
-                elif operator == '<':
-                    sql_request = sql_request.where(field < value)
+    def _cursor_value(self, field_name: str, value):
+        if value is None:
+            return None
+        if isinstance(value, (dict, list)):
+            raise ValueError("Bad cursor value")
+
+        try:
+            return self._filter_value(self._column(field_name), str(value))
+        except NotImplementedError:
+            # type without python_type is passed as it's stored in cursor
+            return value
+
+    _aggregate_functions = ('avg', 'min', 'max', 'last', )
+
+    _serializers_max_size = 256
+
+    _search_modes = ('ilike', 'prefix', 'trigram', 'tsvector', )
+
+    def search_index_ddl(self) -> str:
+        """
+        Returns SQL creating indexes which search_mode of resource needs to not scan the whole table
+        """
+        statements = []
+
+        if self.search_mode == 'tsvector':
+            if self.search_vector_field is not None:
+                vector_field = self._column(self.search_vector_field)
+                statements.append('CREATE INDEX IF NOT EXISTS {table}_{field}_idx ON {table} USING gin ({field});'
+                                  .format(table=vector_field.table.name, field=vector_field.name))
+            else:
+                fields = [self._column(field) for field in self.search_by_fields]
+                if any(field.table is not self.table for field in fields):
+                    raise ValueError("Index on expression can't use fields of joined table, use search_vector_field")
+
+                vector = self._search_vector().compile(dialect=postgresql.dialect())
+                statements.append('CREATE INDEX IF NOT EXISTS {table}_search_idx ON {table} USING gin ({vector});'
+                                  .format(table=self.table.name, vector=vector))
+        else:
+            if self.search_mode != 'prefix':
+                statements.append('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+
+            for field_name in self.search_by_fields:
+                field = self._column(field_name)
+                if self.search_mode == 'prefix':
+                    index = '({} text_pattern_ops)'.format(field.name)
                 else:
-                    raise ParamsValidationException("It's not allowed to filter using this operator")
+                    index = 'USING gin ({} gin_trgm_ops)'.format(field.name)
+
+                statements.append('CREATE INDEX IF NOT EXISTS {table}_{field}_{mode}_idx ON {table} {index};'.format(
+                    table=field.table.name, field=field.name, mode=self.search_mode, index=index))
+
+        return '\n'.join(statements)
+
+    def _build_count_query(self, search: bool, filters: tuple, rows: bool=False):
+        """
+        :param rows: select rows instead of their number, it's used to get planner's estimation
+        """
+        if rows:
+            sql_request = sqlalchemy.select([sqlalchemy.literal_column('1')])
+        else:
+            sql_request = sqlalchemy.select([sqlalchemy.func.count()])
+
+        return self._where(sql_request.select_from(self._select_from()), search, filters)
+
+    def _build_list_query(self, window_count: bool, order_field_name: str, descend_ordering: bool, keyset: bool,
+                          has_cursor: bool, search: bool, filters: tuple, agg: str, field_names: tuple,
+                          ranked: bool, null_cursor: bool=False):
+        """
+        :param null_cursor: value of order field in cursor is null
+        """
+        serializer = self._serializer_of(field_names)
+        order_field = self._column(order_field_name)
+        id_field = self._column(self.id_field)
+
+        if keyset and order_field_name != self.id_field:
+            order_by = (order_field, id_field, )
+        else:
+            order_by = (order_field, )
+
+        if descend_ordering:
+            order_by = tuple(sqlalchemy.desc(field) for field in order_by)
+
+        if keyset and order_field.nullable:
+            # the same placement of nulls as postgres' default one, seek by cursor relies on it
+            order_by = (order_by[0].nullsfirst() if descend_ordering else order_by[0].nullslast(), ) + order_by[1:]
+
+        if ranked:
+            order_by = (sqlalchemy.desc(self._search_rank()), ) + order_by
+
+        if agg is not None:
+            time_field = self._column(self.time_field)
+            group_by_fields = [
+                self._column(field) for field in serializer.fields
+                if field != self.time_field and field not in self.value_fields
+            ]
 
-        if not count:
-            sql_request = sql_request.order_by(order_by)
+            sql_request = sqlalchemy.select(
+                [self._time_bucket(time_field).label(self.serializer.fields[self.time_field])] + [
+                    field.label(serializer.fields[field.name]) for field in group_by_fields
+                ] + [
+                    self._aggregate(agg, self._column(field), time_field).label(serializer.fields[field])
+                    for field in self.value_fields if field in serializer.fields
+                ]
+            ).group_by(sqlalchemy.literal_column('1'), *group_by_fields)
+
+            # bucket is always the first column
+            order_by = (sqlalchemy.literal_column('1'), )
+            if descend_ordering:
+                order_by = (sqlalchemy.desc(order_by[0]), )
+        elif keyset:
+            sql_request = sqlalchemy.select(
+                self._selected_fields(serializer) + [order_field.label('_cursor_order'), id_field.label('_cursor_id')]
+            )
+        elif window_count:
+            sql_request = sqlalchemy.select(
+                self._selected_fields(serializer) + [sqlalchemy.func.count().over().label('_total_count')]
+            )
+        else:
+            sql_request = sqlalchemy.select(self._selected_fields(serializer))
+
+        sql_request = self._where(sql_request.select_from(self._select_from()), search, filters)
+
+        if has_cursor:
+            if order_field_name == self.id_field:
+                cursor_fields = sqlalchemy.tuple_(order_field)
+                cursor_values = sqlalchemy.tuple_(sqlalchemy.bindparam('cursor_id'))
+            elif null_cursor:
+                cursor_fields = id_field
+                cursor_values = sqlalchemy.bindparam('cursor_id')
+            else:
+                cursor_fields = sqlalchemy.tuple_(order_field, id_field)
+                cursor_values = sqlalchemy.tuple_(sqlalchemy.bindparam('cursor_order'), sqlalchemy.bindparam('cursor_id'))
+
+            if descend_ordering:
+                condition = cursor_fields < cursor_values
+            else:
+                condition = cursor_fields > cursor_values
+
+            # comparison with null is null, so rows with null value of order field are sought separately:
+            # they go first with descending ordering and last with ascending one
+            if null_cursor:
+                condition = sqlalchemy.and_(order_field.is_(None), condition)
+                if descend_ordering:
+                    condition = sqlalchemy.or_(condition, order_field.isnot(None))
+            elif order_field_name != self.id_field and order_field.nullable and not descend_ordering:
+                condition = sqlalchemy.or_(condition, order_field.is_(None))
+
+            sql_request = sql_request.where(condition)
+
+        sql_request = sql_request.order_by(*order_by)
 
         if self.paginated:
-            sql_request = sql_request.limit(self.page_size)
-            if page:
-                sql_request = sql_request.offset(page * self.page_size)
-
-        if settings.DEBUG:
-            sql_request_str = str(sql_request).replace('\n', ' ')
-            sql_params = sql_request.compile().params
-            print("request: \"{}\"\nparams: \"{}\";".format(sql_request_str, sql_params))
-
-        _debug_start_time = time.time()
-        items = await asyncpgsa.pg.fetch(sql_request)
-        _debug_end_start_time = time.time()
-
-        time_to_process_request = _debug_end_start_time - _debug_start_time
-
-        if time_to_process_request > 0.5:
-            sql_request_str = str(sql_request).replace('\n', ' ')
-            sql_params = sql_request.compile().params
-            print("SLOW REQUEST: {}; with params: {};".format(sql_request_str, sql_params))
-            print("Time to process request: {}".format(time_to_process_request))
-
-        if count:
-            return [], {
-                'count': items[0][0],
-            }
+            sql_request = sql_request.limit(sqlalchemy.bindparam('limit'))
+            if not keyset:
+                sql_request = sql_request.offset(sqlalchemy.bindparam('offset'))
+
+        return sql_request
+
+    def _where(self, sql_request, search: bool, filters: tuple):
+        """
+        Adds conditions of search and filters to query
+        """
+        if search:
+            sql_request = sql_request.where(self._search_condition())
+
+        for i, (field_name, operator) in enumerate(filters):
+            field = self._column(field_name)
+            value = sqlalchemy.bindparam('filter_{}'.format(i))
+
+            if operator == '=':
+                sql_request = sql_request.where(field == value)
+            elif operator == '!=':
+                sql_request = sql_request.where(field != value)
+            elif operator == '>':
+                sql_request = sql_request.where(field > value)
+            elif operator == '<':
+                sql_request = sql_request.where(field < value)
+            elif operator == '>=':
+                sql_request = sql_request.where(field >= value)
+            elif operator == '<=':
+                sql_request = sql_request.where(field <= value)
+            elif operator == 'in':
+                # list of values is one array param, so query doesn't depend on its length
+                sql_request = sql_request.where(field == sqlalchemy.any_(value))
+            elif operator == 'between':
+                sql_request = sql_request.where(field.between(
+                    sqlalchemy.bindparam('filter_{}_0'.format(i)), sqlalchemy.bindparam('filter_{}_1'.format(i))))
+            else:
+                raise ParamsValidationException("It's not allowed to filter using this operator")
+
+        return sql_request
+
+    def _parse_filters(self, filter: str) -> list:
+        """
+        Returns list of filters (field name, operator, value converted to type of field)
+        """
+        filters = []
+        for field_name, operator, value in self.filter_parser.parse(filter):
+            if field_name not in self.filter_by_fields:
+                raise ParamsValidationException("It's not allowed to filter by this field")
+
+            if operator not in self.filter_by_fields[field_name]:
+                raise ParamsValidationException("It's not allowed to filter by this field using this operator")
+
+            field = self._column(field_name)
+
+            if operator == 'in' and len(value) > self.max_batch_size:
+                raise ParamsValidationException("Too many values, maximum is {}".format(self.max_batch_size))
+
+            try:
+                if operator in ('in', 'between'):
+                    value = tuple(self._filter_value(field, item) for item in value)
+                else:
+                    value = self._filter_value(field, value)
+            except ValueError:
+                raise ParamsValidationException("Bad value for filter by field \"{}\"".format(field_name))
+
+            filters.append((field_name, operator, value))
+
+        return filters
+
+    @staticmethod
+    def _filter_value(field, value: str):
+        python_type = field.type.python_type
 
-        return [self.serializer.serialize(item) for item in items]
+        if python_type is bool:
+            if value.lower() not in ('true', 'false'):
+                raise ValueError("Bad bool value")
+            return value.lower() == 'true'
+        if python_type is datetime.datetime:
+            return datetime.datetime.fromisoformat(value)
+        if python_type is datetime.date:
+            return datetime.date.fromisoformat(value)
 
-    async def get(self, item_id: str) -> object:
-        field = getattr(self.table.c, self.id_field)
+        return python_type(value)
+
+    def _search_condition(self):
+        search_text = sqlalchemy.bindparam('search_text')
+
+        if self.search_mode == 'tsvector':
+            return self._search_vector().op('@@')(self._search_query())
+
+        conditions = []
+        for search_field in self.search_by_fields:
+            field = self._column(search_field)
+            if self.search_mode == 'ilike':
+                conditions.append(field.ilike(search_text, escape='!'))
+            elif self.search_mode == 'prefix':
+                conditions.append(field.like(search_text, escape='!'))
+            else:
+                # custom operators aren't escaped for pyformat paramstyle of dialect
+                conditions.append(field.op('%%')(search_text))
+
+        return sqlalchemy.or_(*conditions)
+
+    def _search_rank(self):
+        if self.search_mode == 'tsvector':
+            return sqlalchemy.func.ts_rank(self._search_vector(), self._search_query())
+
+        similarities = [
+            sqlalchemy.func.similarity(self._column(field), sqlalchemy.bindparam('search_text'))
+            for field in self.search_by_fields
+        ]
+
+        return similarities[0] if len(similarities) == 1 else sqlalchemy.func.greatest(*similarities)
+
+    def _search_vector(self):
+        """
+        Returns search_vector_field or to_tsvector of search_by fields,
+        the expression is rendered without parameters to match index on it
+        """
+        if self.search_vector_field is not None:
+            return self._column(self.search_vector_field)
+
+        document = None
+        for field_name in self.search_by_fields:
+            field = sqlalchemy.func.coalesce(self._column(field_name), sqlalchemy.literal_column("''"))
+            document = field if document is None else document.op('||')(
+                sqlalchemy.literal_column("' '")).op('||')(field)
+
+        return sqlalchemy.func.to_tsvector(self._search_config_literal(), document)
+
+    def _search_query(self):
+        return sqlalchemy.func.plainto_tsquery(self._search_config_literal(), sqlalchemy.bindparam('search_text'))
+
+    def _search_config_literal(self):
+        return sqlalchemy.literal_column("'{}'::regconfig".format(self.search_config))
+
+    def _column(self, name: str):
+        """
+        Returns column of table or of joined table
+        """
+        if name in self.table.c or self.join is None:
+            return getattr(self.table.c, name)
+
+        return getattr(self.join[0].c, name)
+
+    def _selected_fields(self, serializer: PostgreSQLSerializer) -> list:
+        """
+        Returns columns of serializer's fields labeled with their names in response
+        and columns which embedded items refer to
+        """
+        return [self._column(field).label(name) for field, name in serializer.fields.items()] + [
+            self._column(parent_field).label('_embed_{}'.format(i))
+            for i, (_, _, _, parent_field, _, _) in enumerate(self.embed)
+        ]
+
+    async def _add_embedded_items(self, items: list, result, connection=None):
+        """
+        Fetches children of items and adds them to serialized items
+
+        :param items: records selected with _selected_fields
+        :param result: list of serialized items or dict of columns
+        :param connection: connection to make queries with, new one is acquired from pool if it's None
+        """
+        for i, (name, _, _, _, _, _) in enumerate(self.embed):
+            keys = [item['_embed_{}'.format(i)] for item in items]
+            children = await self._fetch_embedded_items(i, keys, connection) if keys else {}
+
+            if type(result) is dict:
+                result[name] = [children.get(key, []) for key in keys]
+            else:
+                for item, key in zip(result, keys):
+                    item[name] = children.get(key, [])
+
+    async def _fetch_embedded_items(self, index: int, keys: list, connection=None) -> dict:
+        """
+        Returns dict parent key -> list of serialized children
+        """
+        _, table, foreign_key, _, serializer, order_by = self.embed[index]
+        foreign_key = getattr(table.c, foreign_key)
+
+        def build_query():
+            sql_request = sqlalchemy.select(
+                [getattr(table.c, field).label(field_name) for field, field_name in serializer.fields.items()] +
+                [foreign_key.label('_parent_key')]
+            ).where(foreign_key == sqlalchemy.any_(sqlalchemy.bindparam('keys')))
+
+            if order_by is not None:
+                if order_by.startswith('-'):
+                    sql_request = sql_request.order_by(sqlalchemy.desc(getattr(table.c, order_by[1:])))
+                else:
+                    sql_request = sql_request.order_by(getattr(table.c, order_by))
+
+            return sql_request
+
+        statement = self.statement_cache.get(('embed', index), build_query)
+        children = await self._query('embed', ('embed', index), statement, statement.bind({'keys': list(set(keys))}),
+                                     connection=connection)
+
+        result = {}
+        for child, serialized_child in zip(children, serializer.serialize_many(children)):
+            result.setdefault(child['_parent_key'], []).append(serialized_child)
+
+        return result
+
+    def _select_from(self):
+        if self.join is not None:
+            return self.table.join(self.join[0], self.join[1])
+
+        return self.table
+
+    @staticmethod
+    def _time_bucket(time_field):
+        bucket = sqlalchemy.bindparam('bucket', type_=sqlalchemy.Integer)
+
+        if time_field.type.python_type is datetime.datetime:
+            return sqlalchemy.func.to_timestamp(
+                sqlalchemy.func.floor(sqlalchemy.extract('epoch', time_field) / bucket) * bucket
+            )
+
+        return (time_field / bucket) * bucket
+
+    @staticmethod
+    def _aggregate(agg: str, field, time_field):
+        if agg == 'avg':
+            return sqlalchemy.func.avg(field)
+        elif agg == 'min':
+            return sqlalchemy.func.min(field)
+        elif agg == 'max':
+            return sqlalchemy.func.max(field)
+        elif agg == 'last':
+            return array_agg(aggregate_order_by(field, time_field.desc()))[1]
+
+        raise ParamsValidationException("Unknown aggregate function")
+
+    async def _get_many(self, ids: str, serializer: PostgreSQLSerializer) -> tuple:
+        field = self._column(self.id_field)
+
+        # converted id -> id as it was passed
+        item_ids = {}
+        for item_id in ids.split(','):
+            item_id = item_id.strip()
+            try:
+                item_ids[field.type.python_type(item_id)] = item_id
+            except ValueError:
+                raise ParamsValidationException("Bad value for filter by field \"{}\"".format(field))
+
+        if not item_ids:
+            raise ParamsValidationException("ids should not be empty")
+
+        if len(item_ids) > self.max_batch_size:
+            raise ParamsValidationException("Too many ids, maximum is {}".format(self.max_batch_size))
+
+        shape = ('get_many', serializer.names)
+        statement = self.statement_cache.get(
+            shape,
+            lambda: sqlalchemy.select(self._selected_fields(serializer) + [field.label('_id')]).select_from(
+                self._select_from()
+            ).where(field == sqlalchemy.any_(sqlalchemy.bindparam('ids'))),
+        )
+        items = await self._query('list', shape, statement, statement.bind({'ids': list(item_ids)}))
+
+        result = dict.fromkeys(item_ids.values())
+        serialized_items = serializer.serialize_many(items)
+        if self.embed:
+            await self._add_embedded_items(items, serialized_items)
+
+        for item_id, item in zip((item['_id'] for item in items), serialized_items):
+            result[item_ids[item_id]] = item
+
+        return result, {
+            'not_found': [item_id for item_id, item in result.items() if item is None],
+        }
+
+    async def get(self, item_id: str, fields: str=None) -> object:
+        serializer = self._get_serializer(fields)
+        field = self._column(self.id_field)
         try:
             item_id = field.type.python_type(item_id)
         except ValueError:
             raise ParamsValidationException("Bad value for filter by field \"{}\"".format(field))
 
-        sql_request = self.table.select().where(
-            field == item_id
+        shape = ('get', serializer.names)
+        statement = self.statement_cache.get(
+            shape,
+            lambda: sqlalchemy.select(self._selected_fields(serializer)).select_from(self._select_from()).where(
+                field == sqlalchemy.bindparam('item_id')
+            ),
         )
-
-        print('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-        print('request: "{}"'.format(sql_request))
-        print('params: "{}"'.format(sql_request.compile().params))
-        print('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-
-        item = await asyncpgsa.pg.fetchrow(sql_request)
+        item = await self._query('get', shape, statement, statement.bind({'item_id': item_id}), 'fetchrow')
 
         if item is None:
             raise ResourceItemDoesNotExistException()
 
-        return self.serializer.serialize(item)
+        start_time = time.perf_counter()
+        result = serializer.serialize_many([item])
+        self._observe('serialization', 'get', start_time)
+        if self.embed:
+            await self._add_embedded_items([item], result)
+
+        return result[0]
 
     async def replace_all(self, items: list):
         raise MethodIsNotAllowedException()
@@ -1,3 +1,5 @@
+import operator
+
 from .base_serializer import BaseSerializer
 from .exceptions import SerializationError
 
@@ -9,6 +11,9 @@ class PostgreSQLSerializer(BaseSerializer):
                 field if ' as ' not in field else field.split(' as ', maxsplit=2)[1]
             for field in fields
         }
+        self.names = tuple(self.fields.values())
+        # tuple of record's columns -> function returning tuple of fields' values
+        self._extractors = {}
 
     def serialize(self, item) -> dict:
         result = {}
@@ -23,3 +28,57 @@ class PostgreSQLSerializer(BaseSerializer):
             """.format(item, result))
 
         return result
+
+    def serialize_many(self, items) -> list:
+        """
+        Serializes list of records with the same columns, values are taken by position
+        without looking up every key of every record
+        """
+        if not items:
+            return []
+
+        extractor = self._get_extractor(tuple(items[0].keys()))
+        names = self.names
+
+        return [dict(zip(names, extractor(item))) for item in items]
+
+    def serialize_columnar(self, items) -> dict:
+        """
+        Serializes items to dict of columns, i.e. {"field1": [item1_value, item2_value, ...], ...}
+        """
+        if not items:
+            return {name: [] for name in self.names}
+
+        indices = self._get_indices(tuple(items[0].keys()))
+
+        return {name: [item[i] for item in items] for name, i in zip(self.names, indices)}
+
+    def _get_extractor(self, columns: tuple):
+        extractor = self._extractors.get(columns)
+        if extractor is None:
+            indices = self._get_indices(columns)
+            if len(indices) == 1:
+                index = indices[0]
+                extractor = lambda item: (item[index], )
+            else:
+                extractor = operator.itemgetter(*indices)
+
+            self._extractors[columns] = extractor
+
+        return extractor
+
+    def _get_indices(self, columns: tuple) -> tuple:
+        """
+        Finds positions of fields in record, field is looked up by its column name first
+        and then by its alias, which is column's label when query selects only fields
+        """
+        indices = []
+        for key, name in self.fields.items():
+            if key in columns:
+                indices.append(columns.index(key))
+            elif name in columns:
+                indices.append(columns.index(name))
+            else:
+                raise SerializationError("field \"{}\" is missing in record with columns {}".format(key, columns))
+
+        return tuple(indices)
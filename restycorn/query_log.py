@@ -0,0 +1,116 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+
+class QueryLog:
+    """
+    Writes slow queries as JSON lines to file or logger. Repeats of query of the same shape
+    (combination of filters, ordering, etc.) are written once per dedupe_seconds with their number and time,
+    so it's easy to see which shapes need index. Plans of sampled slow queries are captured
+    with EXPLAIN (ANALYZE, BUFFERS) in background
+    """
+
+    def __init__(self, path: str=None, logger: logging.Logger=None, explain_sample_rate: float=0.0,
+                 explain_timeout: float=30.0, dedupe_seconds: float=60.0, max_shapes: int=1024):
+        """
+        :param path: file to append lines to, if it's None lines are written to logger
+        :param logger: logger to write lines to with WARNING level, "restycorn.query_log" by default
+        :param explain_sample_rate: fraction of slow queries which are explained, once per dedupe_seconds for shape
+        :param explain_timeout: maximum time of EXPLAIN ANALYZE which runs the query again
+        :param dedupe_seconds: query of the same shape is written again only after this time
+        :param max_shapes: maximum number of shapes whose repeats are counted
+        """
+        self.path = path
+        self.logger = logger or logging.getLogger('restycorn.query_log')
+        self.explain_sample_rate = explain_sample_rate
+        self.explain_timeout = explain_timeout
+        self.dedupe_seconds = dedupe_seconds
+        self.max_shapes = max_shapes
+        # (source, shape) -> [time of writing, number of repeats, their total time, their maximum time]
+        self._shapes = {}
+        # (source, shape) -> time of the last explain
+        self._explained = {}
+        # references to background tasks, otherwise they can be garbage collected
+        self._tasks = set()
+
+    def record(self, source: str, method_name: str, shape: tuple, sql: str, args: list, seconds: float,
+               explain=None):
+        """
+        Records slow query
+
+        :param source: name of table or resource which made the query
+        :param shape: hashable key which is the same for queries differing only by params
+        :param explain: coroutine function returning plan of query by EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON),
+            None if query can't be explained
+        """
+        key = (source, shape)
+        now = time.monotonic()
+        entry = self._shapes.get(key)
+
+        if entry is not None and now - entry[0] < self.dedupe_seconds:
+            entry[1] += 1
+            entry[2] += seconds
+            entry[3] = max(entry[3], seconds)
+        else:
+            line = {
+                'time': time.time(),
+                'source': source,
+                'method': method_name,
+                'shape': shape,
+                'seconds': round(seconds, 6),
+                'sql': sql,
+                'args': args,
+            }
+
+            if entry is not None and entry[1]:
+                line['repeats'] = entry[1]
+                line['repeats_seconds'] = round(entry[2], 6)
+                line['repeats_max_seconds'] = round(entry[3], 6)
+
+            if len(self._shapes) >= self.max_shapes and entry is None:
+                self._shapes.clear()
+                self._explained.clear()
+
+            self._shapes[key] = [now, 0, 0.0, 0.0]
+            self.write(line)
+
+        if explain is not None and self.explain_sample_rate and random.random() < self.explain_sample_rate \
+                and now - self._explained.get(key, -self.dedupe_seconds) >= self.dedupe_seconds:
+            self._explained[key] = now
+
+            task = asyncio.ensure_future(self._explain(source, method_name, shape, sql, explain))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def write(self, line: dict):
+        line = json.dumps(line, default=str)
+
+        if self.path is None:
+            self.logger.warning(line)
+        else:
+            with open(self.path, 'a') as file:
+                file.write(line + '\n')
+
+    async def _explain(self, source: str, method_name: str, shape: tuple, sql: str, explain):
+        line = {
+            'time': time.time(),
+            'source': source,
+            'method': method_name,
+            'shape': shape,
+            'sql': sql,
+        }
+
+        try:
+            plan = await asyncio.wait_for(explain(), self.explain_timeout)
+            line['plan'] = json.loads(plan) if isinstance(plan, str) else plan
+        except Exception as ex:
+            line['explain_error'] = '{}: {}'.format(type(ex).__name__, ex)
+
+        self.write(line)
+
+
+# query log used by resources by default
+default_query_log = QueryLog()
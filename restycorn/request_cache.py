@@ -0,0 +1,121 @@
+import collections
+import sys
+import time
+
+
+class RequestCache:
+    """
+    LRU cache of responses with per entry TTL and limits on number of entries and their total size in bytes
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float, max_bytes: int, stale_seconds: float=0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (value, expiration_time, size)
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        Returns cached value or None if there is no such key or entry is expired
+
+        :param key: hashable key
+        :return:
+        """
+        entry = self._lookup(key, 0)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key) -> tuple:
+        """
+        Returns tuple (value, expiration_time) or None if there is no such key.
+        Expired entry is returned until it's older than stale_seconds
+
+        :param key: hashable key
+        :return:
+        """
+        return self._lookup(key, self.stale_seconds)
+
+    def _lookup(self, key, stale_seconds: float) -> tuple:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if entry[1] + stale_seconds < time.time():
+            if entry[1] + self.stale_seconds < time.time():
+                self._remove(key)
+                self.evictions += 1
+
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return entry[0], entry[1]
+
+    def set(self, key, value, size: int=None):
+        """
+        Puts value to cache evicting least recently used entries if there is not enough space
+
+        :param key: hashable key
+        :param value: value to cache
+        :param size: size of value in bytes, estimated if it's not passed
+        :return:
+        """
+        if size is None:
+            size = estimate_size(value)
+
+        if key in self._entries:
+            self._remove(key)
+
+        if size > self.max_bytes:
+            return
+
+        self._entries[key] = (value, time.time() + self.ttl_seconds, size)
+        self.size_bytes += size
+
+        while len(self._entries) > self.max_size or self.size_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.size_bytes -= size
+
+    def clear(self):
+        self._entries.clear()
+        self.size_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'size_bytes': self.size_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def estimate_size(value) -> int:
+    """
+    Roughly estimates memory used by value including nested containers
+    """
+    size = sys.getsizeof(value)
+
+    if isinstance(value, dict):
+        for key, val in value.items():
+            size += estimate_size(key) + estimate_size(val)
+    elif isinstance(value, (list, tuple)):
+        for val in value:
+            size += estimate_size(val)
+
+    return size
@@ -1,16 +1,52 @@
-import inspect
-import traceback
+import asyncio
+import contextlib
+import hashlib
+import logging
+import time
 
 import aiohttp
-import time
-from aiohttp.web import json_response
+from aiohttp import web
 from .base_resource import BaseResource
-from .exceptions import ResourceItemDoesNotExistException, ParamsValidationException, MethodIsNotAllowedException
+from .concurrency_limiter import ConcurrencyLimiter
+from .exceptions import ResourceItemDoesNotExistException, ParamsValidationException, MethodIsNotAllowedException, \
+    ResourceOverloadedException, QueryTimeoutException
+from .json_encoders import get_json_encoder
+from .metrics import ResourceMetrics
+from .params_binder import ParamsBinder
+from .request_cache import RequestCache
+from .row_stream import RowStream
+
+logger = logging.getLogger(__name__)
 
 
 class ResourceRequestHandler:
-    def __init__(self, resource: BaseResource):
+    def __init__(self, resource: BaseResource, json_encoder='json'):
         self.resource = resource
+        self.json_encoder = get_json_encoder(json_encoder)
+        self.cache = RequestCache(
+            max_size=resource.time_cache_size,
+            ttl_seconds=resource.time_cache_seconds,
+            max_bytes=resource.time_cache_max_bytes,
+            stale_seconds=resource.time_cache_stale_seconds,
+        )
+        # cache key -> task making request, concurrent identical requests wait for the same task
+        self._in_flight = {}
+        # task made by client requests -> number of them waiting for it, it's cancelled when all of them are
+        self._waiters = {}
+        # method name -> binder of its params
+        self._binders = {
+            name: ParamsBinder(getattr(resource, name)) for name in (
+                'list', 'replace_all', 'create', 'delete_all', 'get', 'create_or_replace', 'update', 'delete',
+            )
+        }
+        self.limiter = None
+        if resource.concurrency_limit is not None:
+            self.limiter = self._create_limiter(resource.concurrency_limit)
+        self.method_limiters = {
+            name: self._create_limiter(limit) for name, limit in resource.method_concurrency_limits.items()
+        }
+        self.metrics = ResourceMetrics()
+        resource.metrics = self.metrics
 
     async def request_resource(self, request: aiohttp.ClientRequest):
         kwargs = {}
@@ -21,12 +57,12 @@ class ResourceRequestHandler:
             func = self.resource.replace_all
             kwargs = {'items': await request.json()}
         elif request.method == 'POST':
-            func = self.resource.create,
+            func = self.resource.create
             kwargs = {'items': await request.json()}
         elif request.method == 'DELETE':
             func = self.resource.delete_all
         else:
-            return json_response({
+            return self._json_response({
                 'status': 'error',
                 'error_message': 'Method "{}" is not allowed here'.format(request.method)
             })
@@ -35,7 +71,7 @@ class ResourceRequestHandler:
 
     async def request_resource_item(self, request: aiohttp.ClientRequest):
         if 'id' not in request.match_info:
-            return json_response({
+            return self._json_response({
                 'status': 'error',
                 'error_message': 'id is required',
             })
@@ -57,43 +93,54 @@ class ResourceRequestHandler:
             func = self.resource.delete
             kwargs = {'item_id': item_id}
         else:
-            return json_response({
+            return self._json_response({
                 'status': 'error',
                 'error_message': 'Method "{}" is not allowed here'.format(request.method)
             })
 
         return await self.pre_request(request, func, **kwargs)
 
-    _request_cache = {}
     async def pre_request(self, request, func, **kwargs):
-        if self.resource.time_cached:
-            cache_key = (
-                request.method,
-                str(request.url),
-                func,
-                frozenset(kwargs.items()),
-            )
+        start_time = time.perf_counter()
+        status = 500
+        self.metrics.in_flight += 1
 
-            if cache_key not in self._request_cache:
-                self._request_cache[cache_key] = [
-                    (await self.make_request(request, func, **kwargs)),
-                    time.time() + self.resource.time_cache_seconds,
-                ]
+        try:
+            response = await self._respond(request, func, kwargs)
+            status = response.status
+
+            return response
+        finally:
+            self.metrics.in_flight -= 1
+            self.metrics.observe_request(func.__name__, status, time.perf_counter() - start_time)
+
+    async def _respond(self, request, func, kwargs: dict) -> web.StreamResponse:
+        try:
+            kwargs.update(dict(request.query))
+            kwargs = self._prepare_params(func, kwargs)
+        except ParamsValidationException as ex:
+            response = self._encode_response(({
+                'status': 'error',
+                'error_message': str(ex),
+            }, 400))
+        else:
+            if request.method == 'GET' and self.resource.is_streamed(func.__name__, kwargs):
+                return await self._stream_response(request, func, kwargs)
 
-                if len(self._request_cache) > self.resource.time_cache_size:
-                    self._request_cache.clear()
+            response = await self.get_response(request, func, kwargs)
 
-            response, expiration_time = self._request_cache[cache_key]
+        body, status, etag = response
 
-            if expiration_time < time.time():
-                self._request_cache[cache_key] = (
-                    (await self.make_request(request, func, **kwargs)),
-                    time.time() + self.resource.time_cache_seconds
-                )
+        if etag is not None and self._etag_matches(request.headers.get('If-None-Match'), etag):
+            response = web.Response(status=304)
         else:
-            response = await self.make_request(request, func, **kwargs)
+            response = self._make_http_response(body, status)
+
+        if etag is not None:
+            response.headers['ETag'] = etag
 
-        response = json_response(response[0], status=response[1])
+        if status == 503:
+            response.headers['Retry-After'] = str(self._retry_after(func))
 
         if request.method == 'OPTIONS':
             headers = {
@@ -106,23 +153,282 @@ class ResourceRequestHandler:
 
         return response
 
-    @staticmethod
-    async def make_request(request, func, **kwargs) -> tuple:
+    async def batch_request(self, request, item_id: str=None) -> tuple:
+        """
+        Makes GET request which is part of batch request
+
+        :param request: sub request with method, url and query
+        :param item_id: id of item or None to request the whole resource
+        :return: tuple (body, status)
+        """
+        start_time = time.perf_counter()
+
+        if item_id is None:
+            func = self.resource.list
+            kwargs = {}
+        else:
+            func = self.resource.get
+            kwargs = {'item_id': item_id}
+
         try:
             kwargs.update(dict(request.query))
-            kwargs = ResourceRequestHandler._prepare_params(func, kwargs)
+            kwargs = self._prepare_params(func, kwargs)
+        except ParamsValidationException as ex:
+            response = self._encode_response(({
+                'status': 'error',
+                'error_message': str(ex),
+            }, 400))
+        else:
+            response = await self.get_response(request, func, kwargs)
 
-            result = await func(**kwargs)
+        self.metrics.observe_request(func.__name__, response[1], time.perf_counter() - start_time)
 
-            response = {
-                'status': 'ok',
-            }
+        return response[0], response[1]
+
+    async def get_response(self, request, func, kwargs: dict) -> tuple:
+        """
+        Returns response to request with validated params from cache or from resource
+
+        :return: tuple (body, status, etag)
+        """
+        if request.method == 'GET' or request.method == 'OPTIONS':
+            cache_key = self._cache_key(func, kwargs)
+            cache_entry = self.cache.get_entry(cache_key) if self.resource.time_cached else None
 
-            if type(result) is tuple:
-                response['data'] = result[0]
-                response.update(result[1])
-            else:
-                response['data'] = result
+            if cache_entry is None:
+                return await self._make_shared_request(cache_key, request, func, kwargs)
+
+            response, expiration_time = cache_entry
+
+            if expiration_time - self.resource.time_cache_refresh_ahead_seconds < time.time():
+                self._refresh_in_background(cache_key, request, func, kwargs)
+
+            return response
+
+        return self._encode_response(await self.make_request(request, func, **kwargs), method_name=func.__name__)
+
+    async def _stream_response(self, request, func, kwargs: dict) -> web.StreamResponse:
+        response = await self.make_request(request, func, **kwargs)
+
+        if response[1] != 200 or not isinstance(response[0]['data'], RowStream):
+            http_response = self._make_http_response(self.json_encoder(response[0]), response[1])
+            if response[1] == 503:
+                http_response.headers['Retry-After'] = str(self._retry_after(func))
+
+            return http_response
+
+        stream = response[0].pop('data')
+
+        try:
+            http_response = web.StreamResponse(status=200)
+            http_response.content_type = 'application/json'
+            http_response.charset = 'utf-8'
+            http_response.enable_chunked_encoding()
+            await http_response.prepare(request)
+
+            # the rest of response is encoded as usual and data is added to the end of object
+            await http_response.write(self.json_encoder(response[0])[:-1] + b', "data": [')
+
+            first_chunk = True
+            async for chunk in stream:
+                chunk = self.json_encoder(chunk)[1:-1]
+                if not chunk:
+                    continue
+
+                await http_response.write(chunk if first_chunk else b',' + chunk)
+                first_chunk = False
+
+            await http_response.write(b']}')
+            await http_response.write_eof()
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            # status is already sent, so client can only see that response is broken
+            logger.exception('Error during streaming resource "%s"', request.url)
+            if request.transport is not None:
+                request.transport.abort()
+        finally:
+            await stream.close()
+
+        return http_response
+
+    async def _make_shared_request(self, cache_key, request, func, kwargs: dict) -> tuple:
+        """
+        Makes request or joins identical one which is already in progress,
+        so only one of them goes to the resource
+        """
+        task = self._in_flight.get(cache_key)
+        if task is None:
+            task = asyncio.ensure_future(self._make_request_and_cache(cache_key, request, func, kwargs))
+            self._in_flight[cache_key] = task
+            self._waiters[task] = 0
+
+        # background refresh isn't tracked, it's finished even if client which joined it disconnects
+        tracked = task in self._waiters
+        if tracked:
+            self._waiters[task] += 1
+
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if tracked:
+                self._waiters[task] -= 1
+                if not self._waiters[task]:
+                    del self._waiters[task]
+                    if not task.done():
+                        # every client disconnected, so query is cancelled and connection returns to pool.
+                        # Identical request coming before task finishes cancelling makes its own one
+                        self._in_flight.pop(cache_key, None)
+                        task.cancel()
+
+    def _refresh_in_background(self, cache_key, request, func, kwargs: dict):
+        if cache_key not in self._in_flight:
+            self._in_flight[cache_key] = asyncio.ensure_future(
+                self._make_request_and_cache(cache_key, request, func, kwargs))
+
+    async def _make_request_and_cache(self, cache_key, request, func, kwargs: dict) -> tuple:
+        try:
+            response = await self.make_request(request, func, **kwargs)
+
+            if response[1] == 200 and isinstance(response[0]['data'], RowStream):
+                # streamed result requested not by client directly, e.g. in batch
+                response[0]['data'] = await self._read_stream(response[0]['data'])
+
+            response = self._encode_response(response, with_etag=True, method_name=func.__name__)
+
+            if self.resource.time_cached and response[1] < 500:
+                self.cache.set(cache_key, response, len(response[0]))
+
+            return response
+        finally:
+            # cancelled task may be already replaced by task of identical request
+            if self._in_flight.get(cache_key) is asyncio.current_task():
+                del self._in_flight[cache_key]
+
+    @staticmethod
+    async def _read_stream(stream: RowStream) -> list:
+        try:
+            result = []
+            async for chunk in stream:
+                result += chunk
+
+            return result
+        finally:
+            await stream.close()
+
+    def _json_response(self, data, status: int=200) -> web.Response:
+        return self._make_http_response(self.json_encoder(data), status)
+
+    @staticmethod
+    def _make_http_response(body: bytes, status: int) -> web.Response:
+        return web.Response(body=body, status=status, content_type='application/json', charset='utf-8')
+
+    def _encode_response(self, response: tuple, with_etag: bool=False, method_name: str=None) -> tuple:
+        """
+        Encodes response to json
+
+        :param response: tuple (response, status) returned by make_request
+        :param with_etag: whether to calculate etag for successful response
+        :param method_name: name of resource method to record time of encoding to metrics
+        :return: tuple (body, status, etag), etag is None if it isn't calculated
+        """
+        start_time = time.perf_counter()
+        body = self.json_encoder(response[0])
+        if method_name is not None:
+            self.metrics.observe('encode', method_name, time.perf_counter() - start_time)
+
+        etag = None
+        if with_etag and response[1] == 200:
+            etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+        return body, response[1], etag
+
+    @staticmethod
+    def _etag_matches(if_none_match: str, etag: str) -> bool:
+        if not if_none_match:
+            return False
+
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+
+            if tag == etag or tag == '*':
+                return True
+
+        return False
+
+    @staticmethod
+    def _cache_key(func, params: dict) -> tuple:
+        """
+        Key doesn't depend on order of params in url and their representation, only on their validated values
+        """
+        return func.__name__, frozenset(params.items())
+
+    def caches(self) -> dict:
+        """
+        Returns caches of handler and resource by their names
+        """
+        caches = {'response': self.cache}
+        caches.update(self.resource.caches())
+
+        return caches
+
+    def limiters(self) -> dict:
+        """
+        Returns concurrency limiters by names of methods, "*" is limiter of the whole resource
+        """
+        limiters = dict(self.method_limiters)
+        if self.limiter is not None:
+            limiters['*'] = self.limiter
+
+        return limiters
+
+    def _create_limiter(self, limit: int) -> ConcurrencyLimiter:
+        return ConcurrencyLimiter(limit, self.resource.concurrency_queue_size, self.resource.concurrency_queue_seconds)
+
+    @contextlib.asynccontextmanager
+    async def _limit_concurrency(self, func):
+        """
+        Waits for turn of request in limiters of method and of resource
+        """
+        # waiting in both limiters is limited by one concurrency_queue_seconds
+        deadline = time.monotonic() + self.resource.concurrency_queue_seconds
+
+        async with contextlib.AsyncExitStack() as stack:
+            for limiter in (self.method_limiters.get(func.__name__), self.limiter):
+                if limiter is not None:
+                    await stack.enter_async_context(limiter.slot(deadline))
+
+            yield
+
+    def _retry_after(self, func) -> int:
+        return max((
+            limiter.retry_after() for limiter in (self.method_limiters.get(func.__name__), self.limiter, )
+            if limiter is not None
+        ), default=1)
+
+    async def make_request(self, request, func, **kwargs) -> tuple:
+        try:
+            async with contextlib.AsyncExitStack() as stack:
+                await stack.enter_async_context(self._limit_concurrency(func))
+                result = await func(**kwargs)
+
+                response = {
+                    'status': 'ok',
+                }
+
+                if type(result) is tuple:
+                    response['data'] = result[0]
+                    response.update(result[1])
+                else:
+                    response['data'] = result
+
+                if isinstance(response['data'], RowStream):
+                    # errors of opening cursor are returned with their status before streaming is started
+                    await response['data'].start()
+                    # queries of stream are made while it's read, so slots are released when it's closed
+                    response['data'].add_close_callback(stack.pop_all().aclose)
 
             return response, 200
         except ResourceItemDoesNotExistException:
@@ -140,10 +446,22 @@ class ResourceRequestHandler:
                 'status': 'error',
                 'error_message': str(ex),
             }, 400
-        except BaseException as ex:
-            print(type(ex))
-            print(ex)
-            traceback.print_exc()
+        except ResourceOverloadedException:
+            return {
+                'status': 'error',
+                'error_message': 'Resource is overloaded, try again later',
+            }, 503
+        except QueryTimeoutException:
+            return {
+                'status': 'error',
+                'error_message': 'Request took too long, try to narrow it down',
+            }, 504
+        except asyncio.CancelledError:
+            # client disconnected, its database queries are cancelled on the way up
+            raise
+        except BaseException:
+            logger.exception('Error during processing resource "%s" with request method "%s"',
+                             request.url, request.method)
 
             return {
                 'status': 'error',
@@ -152,39 +470,5 @@ class ResourceRequestHandler:
                 )
             }, 500
 
-    @staticmethod
-    def _prepare_params(func, params: dict) -> dict:
-        signature = inspect.signature(func)
-        signature_params = signature.parameters
-
-        for key, val in params.items():
-            if key not in signature_params:
-                raise ParamsValidationException('key "{}" is not allowed here'.format(key))
-
-        for param_name, parameter_info in signature_params.items():
-            if param_name not in params and parameter_info.default is inspect.Parameter.empty:
-                raise ParamsValidationException('param "{}" is required'.format(param_name))
-
-        try:
-            bind = signature.bind(**params)
-        except TypeError:
-            raise ParamsValidationException('Not enough params')
-
-        bind.apply_defaults()
-
-        result = bind.arguments
-
-        for key, parameter_info in signature_params.items():
-            if key in result:
-                if parameter_info.annotation is inspect.Parameter.empty \
-                        or (parameter_info.default is None and result[key] is None):
-                    continue
-
-                if type(result[key]) is not parameter_info.annotation:
-                    try:
-                        result[key] = parameter_info.annotation(result[key])
-                    except ValueError:
-                        raise ParamsValidationException('key "{}" should be "{}" or type convertible to "{}"'.format(
-                            key, parameter_info.annotation, parameter_info.annotation))
-
-        return result
+    def _prepare_params(self, func, params: dict) -> dict:
+        return self.resource.canonical_params(func.__name__, self._binders[func.__name__].bind(params))
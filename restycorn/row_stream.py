@@ -0,0 +1,48 @@
+class RowStream:
+    """
+    Result of resource method which is sent to client in chunks while it's being read,
+    so the whole result is never kept in memory
+    """
+
+    def __init__(self, chunks):
+        """
+        :param chunks: async generator yielding lists of serialized items
+        """
+        self.chunks = chunks
+        self._first_chunk = None
+        self._close_callbacks = []
+
+    async def start(self):
+        """
+        Reads the first chunk before response is sent, so errors of opening cursor
+        are returned to client with their status instead of broken response
+        """
+        try:
+            self._first_chunk = await self.chunks.__anext__()
+        except StopAsyncIteration:
+            pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._first_chunk is not None:
+            chunk, self._first_chunk = self._first_chunk, None
+            return chunk
+
+        return await self.chunks.__anext__()
+
+    def add_close_callback(self, callback):
+        """
+        :param callback: coroutine function called when stream is closed, like release of resources
+            which are held while stream is read
+        """
+        self._close_callbacks.append(callback)
+
+    async def close(self):
+        try:
+            await self.chunks.aclose()
+        finally:
+            callbacks, self._close_callbacks = self._close_callbacks, []
+            for callback in callbacks:
+                await callback()
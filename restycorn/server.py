@@ -1,12 +1,24 @@
+import asyncio
+import socket
+
 from aiohttp import web
 
 from .base_resource import BaseResource
+from .batch_request_handler import BatchRequestHandler
+from .json_encoders import get_json_encoder
+from .metrics import MetricsRegistry
+from .postgresql import db
 
 from .resource_request_handler import ResourceRequestHandler
+from .supervisor import Supervisor
 
 
 class Server:
-    def __init__(self, host: str="localhost", port: int=4444, access_log_format=None):
+    def __init__(self, host: str="localhost", port: int=4444, access_log_format=None, json_encoder='json'):
+        """
+        :param json_encoder: "json", "orjson", "ujson", "auto" to use the fastest installed one
+            or function encoding value to bytes
+        """
         if port < 0 or port > 65535:
             raise ValueError("Port should be in range 0 - 65535")
 
@@ -17,8 +29,20 @@ class Server:
         self.access_log_format = access_log_format
         self.pre_request_function = None
         self.default_handler = None
+        self.json_encoder = get_json_encoder(json_encoder)
+        # resource name -> ResourceRequestHandler
+        self.resource_handlers = {}
+        self.metrics = MetricsRegistry()
 
-    def run(self):
+    def run(self, workers: int=1, reuse_port: bool=False, shutdown_timeout: float=60.0):
+        """
+        :param workers: number of processes serving requests, if it's more than 1 workers are forked
+            and restarted by supervisor when they exit. Connections to database should be opened
+            in startup handlers, so every worker has its own ones
+        :param reuse_port: if True every worker binds its own socket with SO_REUSEPORT and kernel balances
+            connections between them, otherwise workers accept connections from one socket bound before fork
+        :param shutdown_timeout: time to finish requests in progress on SIGTERM or SIGINT
+        """
         if self.default_handler is not None:
             self.app.router.add_route(
                 'GET',
@@ -26,10 +50,66 @@ class Server:
                 lambda *args, **kwargs: self.request_handler(handler=self.default_handler, *args, **kwargs)
             )
 
-        web.run_app(self.app, host=self.host, port=self.port, access_log_format=self.access_log_format)
+        if workers == 1:
+            # handlers of disconnected clients are cancelled, so are their database queries
+            web.run_app(self.app, host=self.host, port=self.port, access_log_format=self.access_log_format,
+                        shutdown_timeout=shutdown_timeout, handler_cancellation=True)
+            return
+
+        sock = None if reuse_port else self._bind_socket()
+
+        Supervisor(
+            lambda number: self._run_worker(sock, shutdown_timeout),
+            workers,
+            # worker finishes requests in shutdown_timeout, the rest of time is to close its connections
+            shutdown_timeout + 10,
+        ).run()
+
+    def _run_worker(self, sock: socket.socket, shutdown_timeout: float):
+        # loop of parent process can't be used after fork
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+        if sock is None:
+            web.run_app(self.app, host=self.host, port=self.port, access_log_format=self.access_log_format,
+                        shutdown_timeout=shutdown_timeout, reuse_port=True, handler_cancellation=True)
+        else:
+            web.run_app(self.app, sock=sock, access_log_format=self.access_log_format,
+                        shutdown_timeout=shutdown_timeout, handler_cancellation=True)
+
+    def _bind_socket(self) -> socket.socket:
+        family, socket_type, proto, _, address = socket.getaddrinfo(
+            self.host, self.port, type=socket.SOCK_STREAM)[0]
+
+        sock = socket.socket(family, socket_type, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(1024)
+
+        return sock
+
+    def add_startup_handler(self, handler):
+        """
+        Adds coroutine function without arguments which is called when server starts,
+        in every worker if there are many of them. It's the place to connect to database
+        """
+        async def on_startup(app):
+            await handler()
+
+        self.app.on_startup.append(on_startup)
+
+    def add_cleanup_handler(self, handler):
+        """
+        Adds coroutine function without arguments which is called when server stops
+        """
+        async def on_cleanup(app):
+            await handler()
+
+        self.app.on_cleanup.append(on_cleanup)
 
     def register_resource(self, resource_name, resource: BaseResource):
-        handler = ResourceRequestHandler(resource)
+        handler = ResourceRequestHandler(resource, self.json_encoder)
+        self.resource_handlers[resource_name] = handler
+        self.metrics.add_resource(resource_name, handler)
         resource_url = self.base_address + '/' + resource_name
 
         self.app.router.add_route(
@@ -48,16 +128,65 @@ class Server:
             lambda *args, **kwargs: self.request_handler(handler=handler.request_resource_item, *args, **kwargs)
         )
 
+    def enable_batch(self, path: str='_batch', max_concurrency: int=8, max_requests: int=50):
+        """
+        Adds endpoint {base_address}/{path} which accepts POST request with json list of GET sub requests
+        like {"method": "GET", "path": "users/admin", "query": {"fields": "username"}},
+        makes them concurrently using caches of resources and returns list of their responses.
+        pre_request_function is called for the batch request and for every sub request with its path
+
+        :param path: path of endpoint relative to base address
+        :param max_concurrency: maximum number of sub requests of one batch which are made at the same time
+        :param max_requests: maximum number of sub requests in one batch
+        :return:
+        """
+        handler = BatchRequestHandler(
+            self.resource_handlers, self.base_address, max_concurrency, max_requests, self.json_encoder,
+            self._pre_request)
+
+        self.app.router.add_route(
+            '*',
+            self.base_address + '/' + path,
+            lambda *args, **kwargs: self.request_handler(handler=handler.request_batch, *args, **kwargs)
+        )
+
+    def enable_metrics(self, path: str='_metrics'):
+        """
+        Adds endpoint {base_address}/{path} returning metrics of resources and connection pools
+        of restycorn.postgresql.db or asyncpgsa in Prometheus text format. In worker mode every worker
+        has its own metrics
+
+        :param path: path of endpoint relative to base address
+        """
+        self.metrics.add_pool_stats(db.stats)
+        self.metrics.add_connection_waiting(lambda: db.waiting)
+
+        async def handler(request):
+            return web.Response(body=self.metrics.render().encode(), headers={
+                'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+            })
+
+        self.app.router.add_route(
+            'GET',
+            self.base_address + '/' + path,
+            lambda *args, **kwargs: self.request_handler(handler=handler, *args, **kwargs)
+        )
+
     def set_base_address(self, base_address: str):
         self.base_address = base_address
 
     async def request_handler(self, request, handler):
-        if self.pre_request_function:
-            pre_result = await self.pre_request_function(request)
-            if pre_result is not None:
-                return pre_result
+        pre_result = await self._pre_request(request)
+        if pre_result is not None:
+            return pre_result
 
         return await handler(request)
 
+    async def _pre_request(self, request):
+        if self.pre_request_function:
+            return await self.pre_request_function(request)
+
+        return None
+
     def set_default_route(self, handler):
         self.default_handler = handler
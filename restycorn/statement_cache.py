@@ -0,0 +1,85 @@
+from asyncpgsa.connection import get_dialect
+
+
+class CompiledStatement:
+    """
+    SQL text compiled once from sqlalchemy query with positional parameters ($1, $2, ...)
+    and the names of bind params in the order they should be passed
+    """
+
+    def __init__(self, sql: str, param_names: tuple, defaults: dict, processors: dict):
+        self.sql = sql
+        self.param_names = param_names
+        self.defaults = defaults
+        self.processors = processors
+
+    def bind(self, params: dict) -> list:
+        result = []
+        for name in self.param_names:
+            value = params[name] if name in params else self.defaults[name]
+            if name in self.processors:
+                value = self.processors[name](value)
+
+            result.append(value)
+
+        return result
+
+
+class StatementCache:
+    """
+    Caches compiled SQL per query shape. Text of statement is the same for every request with this shape,
+    so asyncpg's per connection statement cache keeps it as server side prepared statement
+    and only bound values are sent
+    """
+
+    _dialect = get_dialect()
+
+    def __init__(self, max_size: int=256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._statements = {}
+
+    def get(self, shape: tuple, build_query) -> CompiledStatement:
+        """
+        Returns compiled statement for shape, build_query is called to construct sqlalchemy query on cache miss
+
+        :param shape: hashable description of query, everything except bound values
+        :param build_query: function without arguments returning sqlalchemy query with named bind params
+        :return:
+        """
+        statement = self._statements.get(shape)
+        if statement is not None:
+            self.hits += 1
+            return statement
+
+        self.misses += 1
+        statement = self.compile(build_query())
+
+        if len(self._statements) >= self.max_size:
+            self._statements.clear()
+
+        self._statements[shape] = statement
+
+        return statement
+
+    @classmethod
+    def compile(cls, query) -> CompiledStatement:
+        compiled = query.compile(dialect=cls._dialect)
+        param_names = tuple(sorted(compiled.params))
+
+        mapping = {name: '$' + str(i) for i, name in enumerate(param_names, start=1)}
+
+        return CompiledStatement(
+            compiled.string % mapping,
+            param_names,
+            compiled.params,
+            compiled._bind_processors,
+        )
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._statements),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
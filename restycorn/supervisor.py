@@ -0,0 +1,127 @@
+import logging
+import os
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor:
+    """
+    Runs workers in forked processes, restarts ones which exit and stops them one by one on SIGTERM or SIGINT,
+    so the rest of workers keep serving requests while every worker finishes its requests
+    """
+
+    # worker which exits sooner than that after start is restarted with delay to not fork in a loop
+    min_worker_uptime = 1.0
+    restart_delay = 1.0
+    poll_interval = 0.2
+
+    def __init__(self, run_worker, workers: int, shutdown_timeout: float=60.0):
+        """
+        :param run_worker: function which is called with number of worker in forked process
+            and returns when worker is stopped
+        :param workers: number of worker processes
+        :param shutdown_timeout: time to wait for worker to exit after SIGTERM before it's killed
+        """
+        if workers < 1:
+            raise ValueError("There should be at least one worker")
+
+        self.run_worker = run_worker
+        self.workers = workers
+        self.shutdown_timeout = shutdown_timeout
+        # pid -> (number of worker, start time)
+        self._processes = {}
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for number in range(self.workers):
+            self._spawn(number)
+
+        while not self._stopping:
+            self._restart_exited_workers()
+            time.sleep(self.poll_interval)
+
+        self._shutdown()
+
+    def _stop(self, signal_number, frame):
+        self._stopping = True
+
+    def _spawn(self, number: int):
+        pid = os.fork()
+
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+            exit_code = 0
+            try:
+                self.run_worker(number)
+            except BaseException:
+                logger.exception('Worker %s failed', number)
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        self._processes[pid] = (number, time.monotonic())
+
+    def _restart_exited_workers(self):
+        while self._processes:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+
+            number, start_time = self._processes.pop(pid)
+            logger.warning('Worker %s (pid %s) exited with %s', number, pid, self._describe(status))
+
+            if time.monotonic() - start_time < self.min_worker_uptime:
+                time.sleep(self.restart_delay)
+
+            if self._stopping:
+                return
+
+            self._spawn(number)
+
+    def _shutdown(self):
+        for pid in list(self._processes):
+            number, _ = self._processes.pop(pid)
+
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+            if not self._wait(pid, self.shutdown_timeout):
+                logger.warning("Worker %s (pid %s) didn't stop in %s seconds, killing it",
+                               number, pid, self.shutdown_timeout)
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+
+    def _wait(self, pid: int, timeout: float) -> bool:
+        """
+        :return: True if process exited in timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                exited_pid, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                return True
+
+            if exited_pid != 0:
+                return True
+
+            if time.monotonic() > deadline:
+                return False
+
+            time.sleep(self.poll_interval)
+
+    @staticmethod
+    def _describe(status: int) -> str:
+        if os.WIFSIGNALED(status):
+            return "signal {}".format(os.WTERMSIG(status))
+
+        return "code {}".format(os.WEXITSTATUS(status))